@@ -0,0 +1,42 @@
+/* Cumulus: Efficient Filesystem Backup to the Cloud
+ * Copyright (C) 2013 The Cumulus Developers
+ * See the AUTHORS file for a list of contributors.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License along
+ * with this program; if not, write to the Free Software Foundation, Inc.,
+ * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+
+/* C-linkage entry points to the chunking code, for building a shared library
+ * that the Python database rebuilder can load with ctypes.  This computes the
+ * same breakpoints as cumulus-chunker-standalone, but without the overhead of
+ * passing every buffer through a pipe to a separate process. */
+
+#include <stddef.h>
+
+#include "third_party/chunk.h"
+
+extern "C" {
+
+int cumulus_chunk_compute_max_num_breaks(size_t buflen)
+{
+    return chunk_compute_max_num_breaks(buflen);
+}
+
+int cumulus_chunk_compute_breaks(const char *buf, size_t len,
+                                 size_t *breakpoints)
+{
+    return chunk_compute_breaks(buf, len, breakpoints);
+}
+
+}
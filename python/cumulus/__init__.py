@@ -45,6 +45,7 @@ try:
 except ImportError:
     import thread as _thread
 
+import cumulus.localdb
 import cumulus.store
 import cumulus.store.file
 import cumulus.util
@@ -58,6 +59,12 @@ MAX_RECURSION_DEPTH = 3
 # All segments which have been accessed this session.
 accessed_segments = set()
 
+# Directory in which snapshot descriptors are cached between runs, so that
+# repeated commands need not fetch them from the storage backend again.  The
+# on-disk cache is off (None) unless a directory is set here, for example
+# os.path.expanduser("~/.cache/cumulus/snapshots"); entries are never removed.
+SNAPSHOT_CACHE_DIR = None
+
 # Table of methods used to filter segments before storage, and corresponding
 # filename extensions.  These are listed in priority order (methods earlier in
 # the list are tried first).
@@ -213,14 +220,20 @@ class SearchPath(object):
 
     def list(self, backend):
         success = False
+        match = self._regex.match
         for d in self.directories():
             try:
-                for f in backend.list(d):
-                    success = True
-                    m = self.match(f)
-                    if m: yield (posixpath.join(d, f), m)
+                # Backends may return a generator, which only raises
+                # NotFoundError once iterated.
+                files = list(backend.list(d))
             except cumulus.store.NotFoundError:
-                pass
+                continue
+            # Names found in the top-level directory need no path prefix.
+            prefix = posixpath.join(d, "") if d else ""
+            for f in files:
+                success = True
+                m = match(f)
+                if m: yield (prefix + f, m)
         if not success:
             raise cumulus.store.NotFoundError(backend)
 
@@ -268,14 +281,21 @@ class BackendWrapper(object):
         store may either be a Store object or URL.
         """
         if isinstance(backend, six.string_types):
+            self._url = backend
             self._backend = cumulus.store.open(backend)
         else:
+            self._url = None
             self._backend = backend
 
     @property
     def raw_backend(self):
         return self._backend
 
+    @property
+    def url(self):
+        """The URL the backend was opened from, or None if not known."""
+        return self._url
+
     def stat_generic(self, basename, filetype):
         return SEARCH_PATHS[filetype].stat(self._backend, basename)
 
@@ -310,6 +330,7 @@ class CumulusStore:
         self.cachedir = None
         self.CACHE_SIZE = 16
         self._lru_list = []
+        self._snapshot_cache = {}
 
     def get_cachedir(self):
         if self.cachedir is None:
@@ -354,9 +375,72 @@ class CumulusStore:
     def list_segments(self):
         return set(x[0] for x in self.backend.list_generic("segments"))
 
+    def _snapshot_cache_path(self, snapshot, stat):
+        """Return the on-disk cache file for a snapshot descriptor.
+
+        stat should be the result of stat_generic for the descriptor.  The
+        cache file name incorporates the backend URL and the path and size
+        reported by the backend, so that a replaced descriptor of a different
+        size is not served from a stale cache entry.  That is the only check:
+        descriptors are written once and never modified, but one rewritten
+        with the same size would go unnoticed.
+        """
+        key = "%s\0%s\0%d" % (self.backend.url, stat["path"], stat["size"])
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(SNAPSHOT_CACHE_DIR,
+                            "%s-%s" % (snapshot, digest[:16]))
+
     def load_snapshot(self, snapshot):
-        snapshot_file = self.backend.open_snapshot(snapshot)[0]
-        return to_lines(snapshot_file.read())
+        if snapshot in self._snapshot_cache:
+            return self._snapshot_cache[snapshot]
+
+        # Locating the descriptor with a stat both validates any cached copy
+        # and tells us exactly where the descriptor is stored, so that on a
+        # cache miss it can be fetched with a single request instead of
+        # probing each location in the search path again.
+        stat = cache_path = None
+        if SNAPSHOT_CACHE_DIR is not None and self.backend.url is not None:
+            try:
+                stat = self.backend.stat_generic("snapshot-" + snapshot,
+                                                 "snapshots")
+                cache_path = self._snapshot_cache_path(snapshot, stat)
+            except cumulus.store.NotFoundError:
+                pass
+
+        # The cache holds the descriptor text as stored, which is parsed
+        # again on load just like a freshly fetched copy.
+        data = None
+        if cache_path is not None:
+            try:
+                with open(cache_path, "rb") as f:
+                    data = f.read()
+            except (IOError, OSError):
+                pass
+            if data is not None and len(data) != stat["size"]:
+                data = None
+
+        if data is None:
+            if stat is not None:
+                snapshot_file = self.backend.raw_backend.get(stat["path"])
+            else:
+                snapshot_file = self.backend.open_snapshot(snapshot)[0]
+            data = snapshot_file.read()
+            if cache_path is not None:
+                # Write to a temporary file and rename, so that concurrent
+                # readers never see a partially-written cache entry.
+                try:
+                    if not os.path.isdir(SNAPSHOT_CACHE_DIR):
+                        os.makedirs(SNAPSHOT_CACHE_DIR)
+                    (fd, tmp_path) = tempfile.mkstemp(dir=SNAPSHOT_CACHE_DIR)
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(data)
+                    os.rename(tmp_path, cache_path)
+                except (IOError, OSError):
+                    pass
+
+        lines = to_lines(data)
+        self._snapshot_cache[snapshot] = lines
+        return lines
 
     @staticmethod
     def filter_data(filehandle, filter_cmd):
@@ -366,7 +450,7 @@ class CumulusStore:
                              stdout=subprocess.PIPE, close_fds=True)
         input, output = p.stdin, p.stdout
         def copy_thread(src, dst):
-            BLOCK_SIZE = 4096
+            BLOCK_SIZE = 64 * 1024
             while True:
                 block = src.read(BLOCK_SIZE)
                 if len(block) == 0: break
@@ -670,6 +754,10 @@ class LocalDatabase:
         "Return a DB-API cursor for directly accessing the local database."
         return self.db_connection.cursor()
 
+    def close(self):
+        "Close the connection, discarding any uncommitted changes."
+        self.db_connection.close()
+
     def list_schemes(self):
         """Return the list of snapshots found in the local database.
 
@@ -685,11 +773,24 @@ class LocalDatabase:
     def list_snapshots(self, scheme):
         """Return a list of snapshots for the given scheme."""
         cur = self.cursor()
-        cur.execute("select name from snapshots")
+        cur.execute("select name from snapshots where scheme = ?", (scheme,))
         snapshots = [row[0] for row in cur.fetchall()]
         snapshots.sort()
         return snapshots
 
+    def list_snapshots_by_scheme(self):
+        """Return the snapshots of all schemes, with a single query.
+
+        The returned value is a dictionary mapping each scheme to a sorted list
+        of its snapshots, as list_snapshots would return them.
+        """
+        cur = self.cursor()
+        cur.execute("select scheme, name from snapshots order by scheme, name")
+        snapshots = {}
+        for (scheme, name) in cur:
+            snapshots.setdefault(scheme, []).append(name)
+        return snapshots
+
     def delete_snapshot(self, scheme, name):
         """Remove the specified snapshot from the database.
 
@@ -701,13 +802,32 @@ class LocalDatabase:
         cur.execute("delete from snapshots where scheme = ? and name = ?",
                     (scheme, name))
 
-    def prune_old_snapshots(self, scheme, intent=1.0):
+    def delete_snapshots(self, scheme, names):
+        """Remove several snapshots of a scheme from the database.
+
+        This is equivalent to calling delete_snapshot for each name, but uses
+        a single statement for up to 500 snapshots at a time.  The same
+        warning about garbage collection applies.
+        """
+        names = list(names)
+        cur = self.cursor()
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            cur.execute("delete from snapshots where scheme = ? and name in (%s)"
+                        % ", ".join("?" * len(batch)),
+                        [scheme] + batch)
+
+    def prune_old_snapshots(self, scheme, intent=1.0, collect=True):
         """Delete entries from old snapshots from the database.
 
         Only snapshots with the specified scheme name will be deleted.  If
         intent is given, it gives the intended next snapshot type, to determine
         how aggressively to clean (for example, intent=7 could be used if the
         next snapshot will be a weekly snapshot).
+
+        If collect is False, garbage_collect() is not run afterwards; this
+        lets callers pruning several schemes collect garbage just once at the
+        end, but garbage_collect() must then be called before committing.
         """
 
         cur = self.cursor()
@@ -748,7 +868,8 @@ class LocalDatabase:
             first = False
             max_intent = max(max_intent, snap_intent)
 
-        self.garbage_collect()
+        if collect:
+            self.garbage_collect()
 
     def garbage_collect(self):
         """Garbage-collect unreachable segment and object data.
@@ -758,6 +879,8 @@ class LocalDatabase:
         """
         cur = self.cursor()
 
+        cumulus.localdb.begin_immediate(self.db_connection)
+
         # Delete entries in the segment_utilization table which are for
         # non-existent snapshots.
         cur.execute("""delete from segment_utilization
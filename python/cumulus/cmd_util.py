@@ -22,8 +22,14 @@ from __future__ import division, print_function, unicode_literals
 
 import getpass, os, stat, sys, time
 from optparse import OptionParser
+try:
+    import keyring
+    import keyring.errors
+except ImportError:
+    keyring = None
 
 import cumulus
+import cumulus.localdb
 
 # We support up to "Cumulus Snapshot v0.11" formats, but are also limited by
 # the cumulus module.
@@ -34,12 +40,42 @@ def check_version(format):
     if ver > FORMAT_VERSION:
         raise RuntimeError("Unsupported Cumulus format: " + format)
 
-# Read a passphrase from the user and store it in the LBS_GPG_PASSPHRASE
-# environment variable.
+# Read a passphrase and store it in the LBS_GPG_PASSPHRASE environment
+# variable, where it is picked up by the gpg filter subprocesses.  If the
+# keyring module is available and holds a password for service "cumulus", user
+# "gpg", that is used; otherwise the user is prompted.
 def get_passphrase():
     ENV_KEY = 'LBS_GPG_PASSPHRASE'
     if ENV_KEY not in os.environ:
-        os.environ[ENV_KEY] = getpass.getpass()
+        passphrase = None
+        if keyring is not None:
+            try:
+                passphrase = keyring.get_password("cumulus", "gpg")
+            except keyring.errors.KeyringError:
+                pass
+        if passphrase is None:
+            passphrase = getpass.getpass()
+        os.environ[ENV_KEY] = passphrase
+
+# Amount of file data to accumulate from consecutive blocks before handing it
+# on to be checksummed or written out.
+BLOCK_FLUSH_SIZE = 4 << 20
+
+def read_file_data(store, m):
+    """Iterate over the data of the file described by metadata item m.
+
+    The data of consecutive blocks is coalesced into buffers of roughly
+    BLOCK_FLUSH_SIZE bytes, so that callers make fewer, larger calls to update
+    checksums and write files.
+    """
+    buf = bytearray()
+    for block in m.data():
+        buf += store.get(block)
+        if len(buf) >= BLOCK_FLUSH_SIZE:
+            yield buf
+            buf = bytearray()
+    if len(buf) > 0:
+        yield buf
 
 def cmd_prune_db(args):
     """ Delete old snapshots from the local database, though do not
@@ -58,10 +94,13 @@ def cmd_clean(args, clean_threshold=7.0):
     """
     db = cumulus.LocalDatabase(options.localdb)
 
-    # Delete old snapshots from the local database.
+    # Delete old snapshots from the local database.  Pruning each scheme only
+    # deletes snapshot rows; the (much more expensive) garbage collection of
+    # unreferenced data is done once for all schemes.
     intent = float(options.intent)
     for s in db.list_schemes():
-        db.prune_old_snapshots(s, intent)
+        db.prune_old_snapshots(s, intent, collect=False)
+    db.garbage_collect()
 
     # Expire segments which are poorly-utilized.
     for s in db.get_segment_cleaning_list():
@@ -84,19 +123,36 @@ def cmd_list_snapshots(args):
 def cmd_list_snapshot_sizes(args):
     """ List size of data needed for each snapshot.
         Syntax: $0 --data=DATADIR list-snapshot-sizes
+                $0 --localdb=LOCALDB list-snapshot-sizes
     """
-    store = cumulus.CumulusStore(options.store)
-    backend = store.backend
-    backend.prefetch_generic()
+    if options.localdb:
+        # All segment membership and size information is available from the
+        # local database in a single query, without contacting the backend.
+        # Only snapshots still tracked in the local database are listed.
+        db = cumulus.localdb.Database(options.localdb)
+        snapshot_segments = db.get_snapshot_segment_sizes()
+        segment_sizes = {}
+        for segments in snapshot_segments.values():
+            segment_sizes.update(segments)
+        snapshots = [(s, set(snapshot_segments[s]))
+                     for s in sorted(snapshot_segments)]
+        get_size = segment_sizes.get
+    else:
+        store = cumulus.CumulusStore(options.store)
+        backend = store.backend
+        backend.prefetch_generic()
+        def get_size(segment):
+            return backend.stat_generic(segment + ".tar", "segments")["size"]
+        def load_segment_lists():
+            for s in sorted(store.list_snapshots()):
+                d = cumulus.parse_full(store.load_snapshot(s))
+                check_version(d['Format'])
+                yield (s, set(d['Segments'].split()))
+        snapshots = load_segment_lists()
+
     previous = set()
     size = 0
-    def get_size(segment):
-        return backend.stat_generic(segment + ".tar", "segments")["size"]
-    for s in sorted(store.list_snapshots()):
-        d = cumulus.parse_full(store.load_snapshot(s))
-        check_version(d['Format'])
-
-        segments = set(d['Segments'].split())
+    for (s, segments) in snapshots:
         (added, removed, addcount, remcount) = (0, 0, 0, 0)
         for seg in segments.difference(previous):
             added += get_size(seg)
@@ -139,8 +195,8 @@ def cmd_garbage_collect(args):
     raw_backend = backend.raw_backend
     for f in to_delete:
         print("Delete:", f)
-        if not options.dry_run:
-            raw_backend.delete(f)
+    if not options.dry_run:
+        raw_backend.delete_many(to_delete)
 cmd_gc = cmd_garbage_collect
 
 def cmd_read_snapshots(snapshots):
@@ -191,8 +247,7 @@ def cmd_verify_snapshots(snapshots):
             print("%s [%d bytes]" % (m.fields['name'], int(m.fields['size'])))
             verifier = cumulus.ChecksumVerifier(m.fields['checksum'])
             size = 0
-            for block in m.data():
-                data = store.get(block)
+            for data in read_file_data(store, m):
                 verifier.update(data)
                 size += len(data)
             if int(m.fields['size']) != size:
@@ -222,15 +277,21 @@ def cmd_restore_snapshot(args):
     destdir = args[1]
     paths = args[2:]
 
+    restore_paths = set(p.rstrip("/") for p in paths)
+
     def matchpath(path):
         "Return true if the specified path should be included in the restore."
 
         # No specification of what to restore => restore everything
-        if len(paths) == 0: return True
-
-        for p in paths:
-            if path == p: return True
-            if path.startswith(p + "/"): return True
+        if len(restore_paths) == 0: return True
+
+        # Check the path itself and each of its parent directories against
+        # the set of requested paths.
+        if path in restore_paths: return True
+        i = path.find("/")
+        while i >= 0:
+            if path[:i] in restore_paths: return True
+            i = path.find("/", i + 1)
         return False
 
     def warn(m, msg):
@@ -279,8 +340,7 @@ def cmd_restore_snapshot(args):
         file = open(destpath, 'wb')
         verifier = cumulus.ChecksumVerifier(m.items.checksum)
         size = 0
-        for block in m.data():
-            data = store.get(block)
+        for data in read_file_data(store, m):
             verifier.update(data)
             size += len(data)
             file.write(data)
@@ -290,8 +350,10 @@ def cmd_restore_snapshot(args):
         if not verifier.valid():
             raise ValueError("Bad checksum found")
 
-    while metadata_segments:
-        (segment, items) = metadata_segments.popitem()
+    # Visit segments in sorted order rather than dictionary order, so that
+    # segments are read from the backend in a predictable, sequential order.
+    for segment in sorted(metadata_segments):
+        items = metadata_segments[segment]
         print("+ Segment", segment)
         for pathname in sorted(items):
             if pathname in metadata_paths:
@@ -37,26 +37,22 @@ _BACKUP_PREFIX = "backup:"
 _TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "D": 86400, "W": 7 * 86400,
                "M": 30 * 86400, "Y": 365 * 86400}
 _INTERVAL_RE = r"(\d+)([smhDWMY])"
+_ALL_INTERVALS = re.compile(_INTERVAL_RE)
 
 def _build_retention_engine(spec):
     """Parse a retention specification and return a RetentionEngine object."""
     policy = retention.RetentionEngine()
     class_re = re.compile(r"^(\w+):((%s)+)$" % _INTERVAL_RE)
-    interval_re = re.compile(r"^%s(.*)$" % _INTERVAL_RE)
     for s in spec.split():
         m = class_re.match(s)
         if not m:
             print("Invalid retain spec:", s)
             continue
-        period = datetime.timedelta()
         classname = m.group(1)
         intervalspec = m.group(2)
-        while intervalspec:
-            m = interval_re.match(intervalspec)
-            seconds = int(m.group(1)) * _TIME_UNITS[m.group(2)]
-            period = period + datetime.timedelta(seconds=seconds)
-            intervalspec = m.group(3)
-        policy.add_policy(classname, period)
+        seconds = sum(int(n) * _TIME_UNITS[u]
+                      for (n, u) in _ALL_INTERVALS.findall(intervalspec))
+        policy.add_policy(classname, datetime.timedelta(seconds=seconds))
     return policy
 
 
@@ -42,6 +42,20 @@ SegmentStatistics = collections.namedtuple(
     ["id", "name", "timestamp", "data_size", "disk_size", "type",
      "bytes_referenced", "utilization"])
 
+# Number of snapshot ids passed to each get_segment_utilizations query.
+UTILIZATION_BATCH = 256
+
+def begin_immediate(connection):
+    """Start a transaction holding the write lock, unless one is open.
+
+    garbage_collect calls this so that all of its deletes run within a single
+    transaction without having to upgrade a deferred transaction's lock part
+    way through.  If the caller already has a transaction open, the deletes
+    simply join it.
+    """
+    if not getattr(connection, "in_transaction", True):
+        connection.execute("begin immediate")
+
 class Database:
     """Access to the local database of snapshot contents and object checksums.
 
@@ -100,6 +114,28 @@ class Database:
             snapshots.setdefault(info.scheme, []).append(info)
         return snapshots
 
+    def get_snapshot_segment_sizes(self):
+        """Returns the segments used by each snapshot, with their sizes.
+
+        The returned value is a dictionary mapping snapshot names, in the form
+        used in snapshot descriptor file names ("scheme-name", or just "name"
+        for snapshots without a scheme), to a dictionary which maps names of
+        the segments referenced by that snapshot to the on-disk segment size.
+        Segments with an unknown size are reported as zero bytes.
+        """
+        cur = self.cursor()
+        cur.execute("""select snapshots.scheme, snapshots.name,
+                              segments.segment, segments.disk_size
+                       from snapshots
+                           join segment_utilization using (snapshotid)
+                           join segments using (segmentid)""")
+        snapshots = {}
+        for (scheme, name, segment, disk_size) in cur.fetchall():
+            if scheme:
+                name = scheme + "-" + name
+            snapshots.setdefault(name, {})[segment] = disk_size or 0
+        return snapshots
+
     def delete_snapshot(self, snapshot):
         """Remove the specified snapshot from the database.
 
@@ -122,6 +158,8 @@ class Database:
         """
         cur = self.cursor()
 
+        begin_immediate(self.db_connection)
+
         # Delete entries in the segment_utilization table which are for
         # non-existent snapshots.
         cur.execute("""delete from segment_utilization
@@ -149,7 +187,7 @@ class Database:
                               datetime(timestamp) as "timestamp [timestamp]",
                               data_size, disk_size, type
                        from segments""")
-        return dict((x[0], SegmentInfo(*x)) for x in cur.fetchall())
+        return dict((x[0], SegmentInfo._make(x)) for x in cur.fetchall())
 
     def get_segment_utilizations(self, snapshots):
         """Computes estimates for the data referenced in each segment.
@@ -158,19 +196,34 @@ class Database:
         segments by the specified set of snapshots.
         """
         cur = self.cursor()
-        segment_info = self.get_segment_info()
-        snapshots = [self._get_id(s) for s in snapshots]
-
-        query = """select segmentid, max(bytes_referenced)
-                   from segment_utilization where snapshotid in (%s)
-                   group by segmentid""" % (",".join(["?"] * len(snapshots)))
+        snapshots = sorted(set(self._get_id(s) for s in snapshots))
+
+        # Pass the snapshot ids in batches of a fixed size, padded with NULL
+        # (which matches no snapshot): this stays below SQLite's limit on the
+        # number of parameters in a statement, and keeps the query text
+        # constant so that the prepared statement can be reused.  Unlike
+        # filling a temporary table, it starts no transaction.  Join against
+        # the segments table and compute the utilization ratio in the query
+        # itself, so that each result row maps directly onto the
+        # SegmentStatistics fields.
+        query = """select segmentid, segment,
+                          datetime(timestamp) as "timestamp [timestamp]",
+                          data_size, disk_size, type,
+                          max(bytes_referenced),
+                          cast(max(bytes_referenced) as real) / data_size
+                   from segment_utilization join segments using (segmentid)
+                   where snapshotid in (%s)
+                   group by segmentid""" % ",".join(["?"] * UTILIZATION_BATCH)
         segments = {}
-        for row in cur.execute(query, snapshots):
-            info = segment_info[row[0]]
-            segments[row[0]] = SegmentStatistics(
-                bytes_referenced=row[1],
-                utilization=row[1]/info.data_size,
-                **info._asdict())
+        for i in range(0, len(snapshots), UTILIZATION_BATCH):
+            batch = snapshots[i:i + UTILIZATION_BATCH]
+            batch += [None] * (UTILIZATION_BATCH - len(batch))
+            for row in cur.execute(query, batch):
+                # A segment may be referenced from snapshots in several
+                # batches, keep the largest number of bytes referenced.
+                old = segments.get(row[0])
+                if old is None or row[6] > old.bytes_referenced:
+                    segments[row[0]] = SegmentStatistics._make(row)
         return segments
 
     def mark_segment_expired(self, segment):
@@ -210,7 +263,8 @@ def run_cleaner(database):
     #   - benefit calculation?
 
     for segment in database.get_segment_utilizations(kept_snapshots).values():
-        if segment.utilization < 0.4:
+        # Segments without a known data size have no utilization
+        if segment.utilization is not None and segment.utilization < 0.4:
             print("Clean segment:", segment)
             database.mark_segment_expired(segment)
 
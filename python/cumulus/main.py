@@ -25,7 +25,6 @@ cumulus-backup program.
 from __future__ import division, print_function, unicode_literals
 
 import datetime
-import re
 import sys
 
 import cumulus
@@ -35,18 +34,23 @@ from cumulus import config
 class FakeOptions:
     pass
 
-def prune_backups(backup_config, scheme):
+def prune_backups(backup_config, scheme, snapshots=None):
+    """Delete expired snapshots of a scheme from the backup storage.
+
+    If given, snapshots should be the names of all snapshots in the storage;
+    this allows listing the storage once when pruning several schemes.
+    """
     store = cumulus.LowlevelDataStore(backup_config.get_global("dest"))
-    snapshot_re = re.compile(r"^(.*)-(.*)$")
+    if snapshots is None:
+        snapshots = store.list_snapshots()
     retention = backup_config.get_retention_for_scheme(scheme)
-    expired_snapshots = []
-    for snapshot in sorted(store.list_snapshots()):
-        m = snapshot_re.match(snapshot)
-        if m.group(1) != scheme: continue
-        timestamp = m.group(2)
-        keep = retention.consider_snapshot(timestamp)
-        if not keep:
-            expired_snapshots.append(snapshot)
+    candidates = []
+    for snapshot in sorted(snapshots):
+        (snapshot_scheme, _, timestamp) = snapshot.rpartition("-")
+        if snapshot_scheme == scheme:
+            candidates.append((snapshot, timestamp))
+    keep = retention.consider_snapshots([t for (_, t) in candidates])
+    expired_snapshots = [s for ((s, _), k) in zip(candidates, keep) if not k]
     # The most recent snapshot is never removed.
     if expired_snapshots: expired_snapshots.pop()
     print(expired_snapshots)
@@ -62,7 +66,8 @@ def prune_backups(backup_config, scheme):
     cmd_util.options = options
     cmd_util.cmd_garbage_collect([])
 
-def prune_localdb(backup_config, scheme, next_snapshot=None):
+def prune_localdb(backup_config, scheme, next_snapshot=None, snapshots=None,
+                  db=None):
     """Clean old snapshots out of the local database.
 
     Clear old snapshots out of the local database, possibly in preparation for
@@ -76,19 +81,25 @@ def prune_localdb(backup_config, scheme, next_snapshot=None):
     Note that in this sense, "evict" merely refers to tracking the snapshots in
     the local database; this function does not delete backups from the backup
     storage.
+
+    snapshots may be given as the list of snapshots of the scheme in the local
+    database, if already known; otherwise it is fetched from the database.  db
+    may be an open LocalDatabase to use instead of opening a new connection.
     """
     # Fetch the list of existing snapshots in the local database.  Pruning only
     # makes sense if there are more than one snapshots present.
-    db = cumulus.LocalDatabase(backup_config.get_global("localdb"))
-    snapshots = sorted(db.list_snapshots(scheme))
+    if db is None:
+        db = cumulus.LocalDatabase(backup_config.get_global("localdb"))
+    if snapshots is None:
+        snapshots = db.list_snapshots(scheme)
+    snapshots = sorted(snapshots)
     if len(snapshots) <= 1:
         return
 
     # Classify the snapshots (daily, weekly, etc.) and keep the most recent one
     # of each category.  Also ensure that the most recent snapshot is retained.
     retention = backup_config.get_retention_for_scheme(scheme)
-    for snapshot in snapshots:
-        retention.consider_snapshot(snapshot)
+    retention.consider_snapshots(snapshots)
     if next_snapshot is not None:
         retention.consider_snapshot(next_snapshot)
     retained = set(retention.last_snapshots().values())
@@ -99,18 +110,28 @@ def prune_localdb(backup_config, scheme, next_snapshot=None):
         print(s, s in retained)
 
     evicted = [s for s in snapshots if s not in retained]
-    for s in evicted:
-        db.delete_snapshot(scheme, s)
+    db.delete_snapshots(scheme, evicted)
     db.garbage_collect()
     db.commit()
 
 def main(argv):
     backup_config = config.CumulusConfig(argv[1])
-    for scheme in backup_config.backup_schemes():
-        print(scheme)
-        #prune_backups(backup_config, scheme)
-        prune_localdb(backup_config, scheme, datetime.datetime.utcnow())
-        #prune_localdb(backup_config, scheme, datetime.datetime(2013, 1, 1))
+
+    # List snapshots once for all schemes, rather than once per scheme, and
+    # prune all of them through the same connection.
+    db = cumulus.LocalDatabase(backup_config.get_global("localdb"))
+    try:
+        localdb_snapshots = db.list_snapshots_by_scheme()
+
+        for scheme in backup_config.backup_schemes():
+            print(scheme)
+            #prune_backups(backup_config, scheme)
+            prune_localdb(backup_config, scheme, datetime.datetime.utcnow(),
+                          localdb_snapshots.get(scheme, []), db)
+            #prune_localdb(backup_config, scheme,
+            #              datetime.datetime(2013, 1, 1))
+    finally:
+        db.close()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -25,18 +25,101 @@ of the filesystem, in sorted order.
 
 from __future__ import division, print_function, unicode_literals
 
+import bisect
+import collections
+import re
+
 import cumulus
 
+# Classification of metadata lines, as computed by Metadata._load_kinds.
+LINE_ITEM = 0
+LINE_BLANK = 1
+LINE_INDIRECT = 2
+
+# A "Key: Value" line, as accepted by cumulus.parse.
+_FIELD_RE = re.compile(r"^([-\w]+):\s*(.*)$")
+
 class Metadata:
+    # Maximum number of loaded objects kept in memory.
+    LOAD_CACHE_SIZE = 64
+
+    # Number of searches after which the whole metadata log is indexed, so
+    # that further searches need not walk the tree.
+    SEARCHES_BEFORE_PRELOAD = 2
+
     def __init__(self, object_store, root):
         self.store = object_store
         self.root = root
+        self._load_cache = collections.OrderedDict()
+        self._index = None
+        self._search_count = 0
+
+    def _load_kinds(self, ref):
+        """Return the lines of the given object along with their kinds.
+
+        The kinds are returned as a bytearray with one LINE_* code per line,
+        so that callers walking the lines need not re-examine each one.
+        Searches revisit the same objects over and over, so the most recently
+        used LOAD_CACHE_SIZE objects are kept.
+        """
+
+        cache = self._load_cache
+        if ref in cache:
+            # Re-insert to mark as most recently used.
+            result = cache.pop(ref)
+            cache[ref] = result
+            return result
+        lines = self.store.get(ref).splitlines()
+        kinds = bytearray(LINE_INDIRECT if l.startswith('@')
+                          else LINE_BLANK if l == "" else LINE_ITEM
+                          for l in lines)
+        cache[ref] = (lines, kinds)
+        if len(cache) > self.LOAD_CACHE_SIZE:
+            cache.popitem(last=False)
+        return (lines, kinds)
 
     def _load(self, ref):
         """Return the contents of the given object, as a list of text lines."""
 
-        data = self.store.get(ref)
-        return data.splitlines()
+        return self._load_kinds(ref)[0]
+
+    @staticmethod
+    def _parse_one(lines, start):
+        """Parse the first metadata item in lines at or after index start.
+
+        This gives the same result as taking the first item produced by
+        cumulus.parse with blank lines as terminators, but without the
+        overhead of setting up a generator for each item read.  Returns a
+        tuple (item, end), where end is the index of the line which ended the
+        item.
+        """
+
+        result = {}
+        last_key = None
+        match = _FIELD_RE.match
+        end = len(lines)
+        for i in range(start, end):
+            l = lines[i]
+            if len(l) > 0 and l[-1] == "\n":
+                l = l[:-1]
+
+            if l == "":
+                if result:
+                    end = i
+                    break
+                last_key = None
+                continue
+
+            m = match(l)
+            if m:
+                last_key = m.group(1)
+                result[last_key] = [m.group(2)]
+            elif l[0].isspace() and last_key is not None:
+                result[last_key].append(l)
+            else:
+                last_key = None
+
+        return (dict((k, "".join(v)) for (k, v) in result.items()), end)
 
     def _read(self, ptr):
         """Parse the metadata item at the given address and return it."""
@@ -44,12 +127,7 @@ class Metadata:
         if ptr is None or ptr == []: return {}
 
         (ref, n) = ptr[-1]
-        lines = self._load(ref)[n:]
-
-        try:
-            return next(cumulus.parse(lines, lambda l: len(l) == 0))
-        except StopIteration:
-            return {}
+        return self._parse_one(self._load(ref), n)[0]
 
     def _advance(self, ptr):
         """Advance the specified metadata pointer to the next metadata item."""
@@ -65,7 +143,7 @@ class Metadata:
 
         while True:
             last = ptr.pop(-1)
-            lines = self._load(last[0])
+            (lines, kinds) = self._load_kinds(last[0])
 
             # Reached the end of the current object?  Advance pointer by one
             # line in the containing object (or return None if reached the very
@@ -78,15 +156,15 @@ class Metadata:
                 continue
 
             # Reached a line with an indirect reference?  Recurse.
-            line = lines[last[1]]
-            if line.startswith('@'):
+            kind = kinds[last[1]]
+            if kind == LINE_INDIRECT:
                 ptr.append(last)
-                ptr.append((line[1:], 0))
+                ptr.append((lines[last[1]][1:], 0))
                 advanced = True
                 continue
 
             # Skip over blank lines.
-            if line == "":
+            if kind == LINE_BLANK:
                 ptr.append((last[0], last[1] + 1))
                 advanced = True
                 continue
@@ -105,7 +183,7 @@ class Metadata:
         if ptr1 is None and ptr2 is None: return 0
         if ptr1 is None: return 1
         if ptr2 is None: return -1
-        return cmp(ptr1, ptr2)
+        return (ptr1 > ptr2) - (ptr1 < ptr2)
 
     def _get_path(self, metadata):
         if metadata is None or 'name' not in metadata:
@@ -141,7 +219,8 @@ class Metadata:
                 limit = ptr2[level][1]
             midpoint.append((lastref, (ptr1[level][1] + limit) // 2))
 
-            if self._cmp(midpoint, ptr1) < 0:
+            # Neither pointer can be None here, so compare them directly.
+            if midpoint < ptr1:
                 #print "    ...descend"
                 level += 1
                 continue
@@ -157,13 +236,57 @@ class Metadata:
 
             return midpoint
 
+    def preload(self):
+        """Build an index of all metadata items for fast searching.
+
+        The index holds the pointers to all items in order, along with the
+        corresponding paths.  Since the metadata log is sorted by path, a
+        search is then a plain binary search over this array.
+        """
+
+        ptrs = []
+        paths = []
+        ptr = self._advance([])
+        while ptr is not None:
+            ptrs.append(ptr)
+            paths.append(self._get_path(self._read(ptr)))
+            ptr = self._advance(ptr)
+        self._index = (ptrs, paths)
+
+    def _search_index(self, searchfunc, ptr1, ptr2):
+        """Binary search over the index built by preload."""
+
+        (ptrs, paths) = self._index
+        lo = bisect.bisect_left(ptrs, ptr1) if ptr1 else 0
+        hi = bisect.bisect_left(ptrs, ptr2) if ptr2 is not None else len(ptrs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            c = searchfunc(paths[mid])
+            if c == 0:
+                return ptrs[mid]
+            elif c < 0:
+                lo = mid + 1
+            else:
+                hi = mid
+        return ptrs[lo] if lo < len(ptrs) else None
+
     def search(self, searchfunc, ptr1=[], ptr2=None):
         """Perform a binary search for name.
 
         The search is restricted to the interval [ptr1, ptr2).  Return either a
         pointer to the item for name, or if it doesn't exist the pointer to the
         item which follows where it would have been (assuming the original
-        search interval included that location)."""
+        search interval included that location).
+
+        Once a few searches have been made, all items are indexed with preload
+        and later searches use the index."""
+
+        if self._index is None:
+            self._search_count += 1
+            if self._search_count > self.SEARCHES_BEFORE_PRELOAD:
+                self.preload()
+        if self._index is not None:
+            return self._search_index(searchfunc, ptr1, ptr2)
 
         def _printable(ptr):
             if ptr is None: return None
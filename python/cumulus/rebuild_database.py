@@ -29,14 +29,19 @@ given data from a previous backup.
 from __future__ import division, print_function, unicode_literals
 
 import base64
+import ctypes
 import hashlib
 import itertools
+import mmap
+import multiprocessing
 import os
 import re
+import sqlite3
 import struct
 import subprocess
 import sys
 import tarfile
+import threading
 import time
 
 import cumulus
@@ -44,10 +49,20 @@ from cumulus import util
 
 CHECKSUM_ALGORITHM = "sha224"
 CHUNKER_PROGRAM = "cumulus-chunker-standalone"
+CHUNKER_LIBRARY = "libcumulus-chunker.so"
 
 # TODO: Move to somewhere common
 SQLITE_TIMESTAMP = "%Y-%m-%d %H:%M:%S"
 
+def advise(fd, advice):
+    """Pass an access pattern hint for an open file to the kernel.
+
+    advice is the name of one of the os.POSIX_FADV_* constants.  This is a
+    no-op where os.posix_fadvise is unavailable.
+    """
+    if hasattr(os, "posix_fadvise") and hasattr(os, advice):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
 class Chunker(object):
     """Compute sub-file chunk boundaries using a sliding Rabin fingerprint.
 
@@ -68,24 +83,46 @@ class Chunker(object):
     # present).
     MINIMUM_OBJECT_SIZE = 16384
 
+    # Lookup tables shared by all instances, built on first use; see
+    # _build_tables.
+    _tables = None
+
     def __init__(self):
-        degree = self.MODULUS.bit_length() - 1
-        self.degree = degree
+        if Chunker._tables is None:
+            Chunker._tables = self._build_tables()
+        (self.degree, self.T, self.U) = Chunker._tables
+
+        self.hash_algorithm = cumulus.CHECKSUM_ALGORITHMS[CHECKSUM_ALGORITHM]
+        self.hash_size = self.hash_algorithm().digest_size
+
+        # Layout of a single entry in the stored signatures: the chunk size
+        # followed by its digest.
+        self.signature_format = "H%ds" % self.hash_size
+        self.signature_record = struct.Struct(">" + self.signature_format)
+
+    @classmethod
+    def _build_tables(cls):
+        """Compute the polynomial lookup tables used for chunking.
+
+        These depend only on the chunking parameters, so they are computed
+        once and shared between Chunker instances.
+        """
+        degree = cls.MODULUS.bit_length() - 1
 
         # Lookup table for polynomial reduction when shifting a new byte in,
         # based on the high-order bits.
-        self.T = [self.polymult(1, i << degree, self.MODULUS) ^ (i << degree)
-                  for i in range(256)]
+        T = tuple(cls.polymult(1, i << degree, cls.MODULUS) ^ (i << degree)
+                  for i in range(256))
 
         # Values to remove a byte from the signature when it falls out of the
         # window.
-        self.U = [self.polymult(i, 1 << 8*(self.WINDOW_SIZE - 1),
-                                self.MODULUS) for i in range(256)]
+        U = tuple(cls.polymult(i, 1 << 8*(cls.WINDOW_SIZE - 1), cls.MODULUS)
+                  for i in range(256))
 
-        self.hash_algorithm = cumulus.CHECKSUM_ALGORITHMS[CHECKSUM_ALGORITHM]
-        self.hash_size = self.hash_algorithm().digestsize
+        return (degree, T, U)
 
-    def polymult(self, x, y, n):
+    @staticmethod
+    def polymult(x, y, n):
         # Polynomial multiplication: result = x * y
         result = 0
         for i in range(x.bit_length()):
@@ -114,20 +151,46 @@ class Chunker(object):
         signature[2][offset] = byte
 
     def compute_breaks(self, buf):
+        # This is the per-byte inner loop of the pure-Python chunker, so the
+        # computation of window_update is inlined here with the signature
+        # state and the lookup tables held in local variables.  Iterating over
+        # a bytearray yields integer byte values on both Python 2 and 3.
+        T, U, degree = self.T, self.U, self.degree
+        window_size = self.WINDOW_SIZE
+        target_size = self.TARGET_CHUNK_SIZE
+        breakmark = self.BREAKMARK_VALUE
+        min_size, max_size = self.MIN_CHUNK_SIZE, self.MAX_CHUNK_SIZE
+
+        (poly, offset, history) = self.window_init()
         breaks = [0]
-        signature = self.window_init()
-        for i in range(len(buf)):
-            self.window_update(signature, ord(buf[i]))
-            block_len = i - breaks[-1] + 1
-            if ((signature[0] % self.TARGET_CHUNK_SIZE == self.BREAKMARK_VALUE
-                        and block_len >= self.MIN_CHUNK_SIZE)
-                    or block_len >= self.MAX_CHUNK_SIZE):
-                breaks.append(i + 1)
+        last_break = 0
+        for (i, byte) in enumerate(bytearray(buf)):
+            poly = ((poly ^ U[history[offset]]) << 8) + byte
+            poly ^= T[poly >> degree]
+            history[offset] = byte
+            offset += 1
+            if offset == window_size:
+                offset = 0
+
+            block_len = i - last_break + 1
+            if ((poly % target_size == breakmark and block_len >= min_size)
+                    or block_len >= max_size):
+                last_break = i + 1
+                breaks.append(last_break)
         if breaks[-1] < len(buf):
             breaks.append(len(buf))
         return breaks
 
-    def compute_signatures(self, buf, buf_offset=0):
+    def compute_breaks_batch(self, bufs):
+        """Compute chunk boundaries for each of a sequence of buffers.
+
+        Returns a list with the result of compute_breaks for each buffer.
+        Subclasses may override this to process the buffers more efficiently
+        than one at a time.
+        """
+        return [self.compute_breaks(buf) for buf in bufs]
+
+    def compute_signatures(self, buf, buf_offset=0, breaks=None):
         """Break a buffer into chunks and compute chunk signatures.
 
         Args:
@@ -135,60 +198,74 @@ class Chunker(object):
             buf_offset: The offset of the data buffer within the original
                 block, to handle cases where only a portion of the block is
                 available.
+            breaks: The chunk boundaries in buf, if already computed (for
+                example by compute_breaks_batch).
 
         Returns:
             A dictionary containing signature data.  Keys are chunk offsets
             (from the beginning of the block), and values are tuples (size, raw
             hash value).
         """
-        breaks = self.compute_breaks(buf)
+        if breaks is None:
+            breaks = self.compute_breaks(buf)
+        # Slices of a memoryview are hashed without copying the chunk data.
+        data = memoryview(buf)
+        hash_algorithm = self.hash_algorithm
         signatures = {}
-        for i in range(1, len(breaks)):
-            chunk = buf[breaks[i-1]:breaks[i]]
-            hasher = self.hash_algorithm()
-            hasher.update(chunk)
-            signatures[breaks[i-1] + buf_offset] = (breaks[i] - breaks[i-1],
-                                                    hasher.digest())
+        for (start, end) in zip(breaks, breaks[1:]):
+            hasher = hash_algorithm()
+            hasher.update(data[start:end])
+            signatures[start + buf_offset] = (end - start, hasher.digest())
         return signatures
 
     def dump_signatures(self, signatures):
         """Convert signatures to the binary format stored in the database."""
-        records = []
+        record = self.signature_record.pack
+        records = bytearray()
 
         # Emit records indicating that no signatures are available for the next
         # n bytes.  Since the size is a 16-bit value, to skip larger distances
         # multiple records must be emitted.  An all-zero signature indicates
         # the lack of data.
+        null_digest = b"\x00" * self.hash_size
         def skip(n):
             while n > 0:
                 i = min(n, self.MAX_CHUNK_SIZE)
-                records.append(struct.pack(">H", i) + "\x00" * self.hash_size)
+                records.extend(record(i, null_digest))
                 n -= i
 
+        # The signatures must be emitted in order of offset.  They may have
+        # been merged from several partial views of a block which were seen in
+        # any order (and dictionaries are unordered on Python 2), so sort here;
+        # the common case of a single, already ordered run sorts in linear time.
         position = 0
         for next_start, (size, digest) in sorted(signatures.items()):
             if next_start < position:
                 print("Warning: overlapping signatures, ignoring")
                 continue
             skip(next_start - position)
-            records.append(struct.pack(">H", size) + digest)
+            records.extend(record(size, digest))
             position = next_start + size
 
-        return "".join(records)
+        return bytes(records)
 
     def load_signatures(self, signatures):
         """Loads signatures from the binary format stored in the database."""
-        entry_size = 2 + self.hash_size
+        entry_size = self.signature_record.size
         if len(signatures) % entry_size != 0:
             print("Warning: Invalid signatures to load")
             return {}
 
-        null_digest = "\x00" * self.hash_size
+        # Unpack all records with a single call, giving a flat sequence of
+        # alternating sizes and digests.
+        count = len(signatures) // entry_size
+        fields = struct.unpack(">" + self.signature_format * count,
+                               bytes(signatures))
+
+        null_digest = b"\x00" * self.hash_size
         position = 0
         result = {}
-        for i in range(len(signatures) // entry_size):
-            sig = signatures[i*entry_size:(i+1)*entry_size]
-            size, digest = struct.unpack(">H", sig[:2])[0], sig[2:]
+        for (size, digest) in zip(fields[0::2], fields[1::2]):
             if digest != null_digest:
                 result[position] = (size, digest)
             position += size
@@ -217,13 +294,104 @@ class ChunkerExternal(Chunker):
         breaks = self.subproc.stdout.readline()
         return [0] + [int(x) + 1 for x in breaks.split()]
 
+    def compute_breaks_batch(self, bufs):
+        # Rather than waiting for the result of each buffer before sending the
+        # next, write all buffers to the helper from a separate thread while
+        # reading the results back here.  Using a thread for the writes avoids
+        # deadlock if the helper blocks writing results that have not been
+        # read yet.
+        bufs = [buf for buf in bufs]
+        def feed():
+            for buf in bufs:
+                if len(buf) > 0:
+                    self.subproc.stdin.write(struct.pack(">i", len(buf)))
+                    self.subproc.stdin.write(buf)
+            self.subproc.stdin.flush()
+        writer = threading.Thread(target=feed)
+        writer.start()
+        results = []
+        try:
+            for buf in bufs:
+                if len(buf) == 0:
+                    results.append([0])
+                    continue
+                breaks = self.subproc.stdout.readline()
+                results.append([0] + [int(x) + 1 for x in breaks.split()])
+        finally:
+            writer.join()
+        return results
+
+
+class ChunkerLibrary(Chunker):
+    """A Chunker which calls into a shared library to find chunk boundaries.
+
+    This uses the same C++ code as ChunkerExternal, but calls it in-process
+    through ctypes, avoiding a pipe round trip to a helper process for each
+    buffer.  Raises OSError if the library cannot be loaded.
+    """
+
+    def __init__(self):
+        super(ChunkerLibrary, self).__init__()
+        # Look for the library on the default search path first, then in the
+        # top of the source tree where "make" builds it.
+        source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  os.pardir, os.pardir)
+        error = None
+        for path in (CHUNKER_LIBRARY,
+                     os.path.join(source_dir, CHUNKER_LIBRARY)):
+            try:
+                self.lib = ctypes.CDLL(path)
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+
+        self.lib.cumulus_chunk_compute_max_num_breaks.argtypes = [
+            ctypes.c_size_t]
+        self.lib.cumulus_chunk_compute_max_num_breaks.restype = ctypes.c_int
+        self.lib.cumulus_chunk_compute_breaks.argtypes = [
+            ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_size_t)]
+        self.lib.cumulus_chunk_compute_breaks.restype = ctypes.c_int
+
+    def compute_breaks(self, buf):
+        if len(buf) == 0:
+            return [0]
+        max_breaks = self.lib.cumulus_chunk_compute_max_num_breaks(len(buf))
+        breaks = (ctypes.c_size_t * max_breaks)()
+        if not isinstance(buf, bytes):
+            # ctypes can only pass read-only data from a bytes object.
+            buf = bytes(buf)
+        count = self.lib.cumulus_chunk_compute_breaks(buf, len(buf), breaks)
+        return [0] + [x + 1 for x in breaks[:count]]
+
 
 class DatabaseRebuilder(object):
+    # Maximum number of blocks for which chunk boundaries are computed in a
+    # single batch.
+    SIGNATURE_BATCH_SIZE = 32
+
+    # Number of files processed between commits while rebuilding, so that
+    # an interrupted rebuild keeps most of its work.
+    COMMIT_INTERVAL = 1000
+
     def __init__(self, database):
         self.database = database
         self.cursor = database.cursor()
-        self.segment_ids = {}
-        self.chunker = ChunkerExternal()
+
+        # Rebuilding is a bulk load which can simply be rerun if interrupted,
+        # so trade some durability for speed.  These settings only apply to
+        # this connection.
+        self.cursor.execute("pragma synchronous = normal")
+        self.cursor.execute("pragma temp_store = memory")
+        self.cursor.execute("pragma cache_size = -65536")
+        self.segment_ids = dict(
+            (segment, segmentid) for (segmentid, segment)
+            in self.cursor.execute("select segmentid, segment from segments"))
+        try:
+            self.chunker = ChunkerLibrary()
+        except OSError:
+            self.chunker = ChunkerExternal()
         #self.chunker = Chunker()
 
     def segment_to_id(self, segment):
@@ -246,16 +414,24 @@ class DatabaseRebuilder(object):
                 similar to data in the metadata log (used to recompute block
                 signatures).
         """
+        file_count = 0
         for fields in cumulus.parse(metadata, lambda l: len(l) == 0):
             metadata = cumulus.MetadataItem(fields, None)
             # Only process regular files; skip over other types (directories,
             # symlinks, etc.)
             if metadata.items.type not in ("-", "f"): continue
+            file_count += 1
+            if file_count % self.COMMIT_INTERVAL == 0:
+                self.database.commit()
             try:
                 path = os.path.join(reference_path, metadata.items.name)
                 print("Path:", path)
                 # TODO: Check file size for early abort if different
-                self.rebuild_file(open(path), metadata)
+                with open(path, "rb") as fp:
+                    # The whole file is read in order, so have the kernel
+                    # start reading ahead while earlier blocks are processed.
+                    advise(fp.fileno(), "POSIX_FADV_WILLNEED")
+                    self.rebuild_file(fp, metadata)
             except IOError as e:
                 print(e)
                 pass  # Ignore the file
@@ -278,10 +454,12 @@ class DatabaseRebuilder(object):
 
     def insert_segment_info(self, segment, info):
         id = self.segment_to_id(segment)
-        for k, v in info.items():
-            self.cursor.execute("update segments set " + k + " = ? "
-                                "where segmentid = ?",
-                                (v, id))
+        if not info: return
+        keys = sorted(info)
+        self.cursor.execute("update segments set "
+                            + ", ".join(k + " = ?" for k in keys)
+                            + " where segmentid = ?",
+                            [info[k] for k in keys] + [id])
 
     def rebuild_file(self, fp, metadata):
         """Recompute database signatures if a file is unchanged.
@@ -292,8 +470,21 @@ class DatabaseRebuilder(object):
         """
         blocks = [cumulus.CumulusStore.parse_ref(b) for b in metadata.data()]
         verifier = cumulus.ChecksumVerifier(metadata.items.checksum)
+        read = self.block_reader(fp)
         checksums = {}
         subblock = {}
+
+        # Blocks needing subblock signatures are queued up, so that chunk
+        # boundaries for several blocks can be computed in one batch.
+        pending = []
+        def compute_pending_signatures():
+            bufs = [buf for (key, buf, start) in pending]
+            all_breaks = self.chunker.compute_breaks_batch(bufs)
+            for ((key, buf, start), breaks) in zip(pending, all_breaks):
+                signatures = self.chunker.compute_signatures(buf, start,
+                                                             breaks)
+                subblock.setdefault(key, {}).update(signatures)
+            del pending[:]
         for segment, object, checksum, slice in blocks:
             # Given a reference to a block of unknown size we don't know how to
             # match up the data, so we have to give up on rebuilding for this
@@ -301,7 +492,7 @@ class DatabaseRebuilder(object):
             if slice is None: return
 
             start, length, exact = slice
-            buf = fp.read(length)
+            buf = read(length)
             verifier.update(buf)
 
             # Zero blocks get no checksums, so skip further processing on them.
@@ -318,8 +509,10 @@ class DatabaseRebuilder(object):
                                                 csum)
 
             if length >= self.chunker.MINIMUM_OBJECT_SIZE or not exact:
-                signatures = self.chunker.compute_signatures(buf, start)
-                subblock.setdefault((segment, object), {}).update(signatures)
+                pending.append(((segment, object), buf, start))
+                if len(pending) >= self.SIGNATURE_BATCH_SIZE:
+                    compute_pending_signatures()
+        compute_pending_signatures()
 
         if verifier.valid():
             for k in subblock:
@@ -328,54 +521,178 @@ class DatabaseRebuilder(object):
         else:
             print("Checksum mismatch")
 
+    # Maximum number of objects looked up in a single select statement, to
+    # stay below the SQLite limit on the number of host parameters.
+    LOOKUP_BATCH_SIZE = 500
+
+    @staticmethod
+    def block_reader(fp):
+        """Return a function reading consecutive blocks from fp.
+
+        Where possible the file is memory-mapped, and blocks are returned as
+        memoryview slices of the mapping so that file data is not copied.
+        Otherwise (empty files, files which cannot be mapped, or Python 2,
+        where mmap objects do not support memoryview) this falls back to
+        fp.read.
+        """
+        try:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            data = memoryview(mapping)
+        except (EnvironmentError, TypeError, ValueError):
+            return fp.read
+        if hasattr(mapping, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+        position = [fp.tell()]
+        def read(length):
+            offset = position[0]
+            position[0] = min(offset + length, len(data))
+            return data[offset:position[0]]
+        return read
+
     def store_checksums(self, block_checksums, subblock_signatures):
-        for (segment, object), (size, checksum) in block_checksums.items():
-            segmentid = self.segment_to_id(segment)
-            self.cursor.execute(
-                """insert or ignore into block_index(segmentid, object)
-                   values (?, ?)""",
-                (segmentid, object))
-            self.cursor.execute("""select blockid from block_index
-                                   where segmentid = ? and object = ?""",
-                                (segmentid, object))
-            blockid = self.cursor.fetchall()[0][0]
+        keys = [((self.segment_to_id(segment), object), (segment, object))
+                for (segment, object) in block_checksums]
+        self.cursor.executemany(
+            """insert or ignore into block_index(segmentid, object)
+               values (?, ?)""", [k for (k, _) in keys])
+        keys = dict(keys)
+
+        # Recover the block ids of all objects, one query per batch of
+        # objects in the same segment.
+        blockids = {}
+        objects_by_segment = {}
+        for (segmentid, object) in keys:
+            objects_by_segment.setdefault(segmentid, []).append(object)
+        for segmentid, objects in objects_by_segment.items():
+            for i in range(0, len(objects), self.LOOKUP_BATCH_SIZE):
+                batch = objects[i:i + self.LOOKUP_BATCH_SIZE]
+                self.cursor.execute(
+                    """select blockid, object from block_index
+                       where segmentid = ? and object in (%s)"""
+                    % ", ".join("?" * len(batch)),
+                    [segmentid] + batch)
+                for (blockid, object) in self.cursor:
+                    blockids[keys[(segmentid, object)]] = blockid
+
+        checksum_updates = []
+        size_updates = []
+        signature_inserts = []
+        for key, (size, checksum) in block_checksums.items():
+            blockid = blockids[key]
 
             # Store checksum only if it is available; we don't want to
             # overwrite an existing checksum in the database with NULL.
             if checksum is not None:
-                self.cursor.execute("""update block_index
-                                       set checksum = ?
-                                       where blockid = ?""",
-                                    (checksum, blockid))
+                checksum_updates.append((checksum, blockid))
 
             # Update the object size.  Our size may be an estimate, based on
             # slices that we have seen.  The size in the database must not be
             # larger than the true size, but update it to the largest value
             # possible.
-            self.cursor.execute("""update block_index
-                                   set size = max(?, coalesce(size, 0))
-                                   where blockid = ?""",
-                                (size, blockid))
+            size_updates.append((size, blockid))
 
             # Store subblock signatures, if available.
             # TODO: Even better would be to merge signature data, to handle the
             # case where different files see different chunks of a block.
-            sigs = subblock_signatures.get((segment, object))
+            sigs = subblock_signatures.get(key)
             if sigs:
-                self.cursor.execute(
-                    """insert or replace into subblock_signatures(
-                           blockid, algorithm, signatures)
-                       values (?, ?, ?)""",
-                    (blockid, self.chunker.ALGORITHM_NAME, buffer(sigs)))
+                signature_inserts.append(
+                    (blockid, self.chunker.ALGORITHM_NAME, sqlite3.Binary(sigs)))
+
+        self.cursor.executemany("""update block_index set checksum = ?
+                                   where blockid = ?""", checksum_updates)
+        self.cursor.executemany("""update block_index
+                                   set size = max(?, coalesce(size, 0))
+                                   where blockid = ?""", size_updates)
+        self.cursor.executemany(
+            """insert or replace into subblock_signatures(
+                   blockid, algorithm, signatures)
+               values (?, ?, ?)""", signature_inserts)
+
+
+class _ChecksummingReader(object):
+    """File wrapper which checksums and counts all data read through it."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+        self.checksummer = cumulus.ChecksumCreator(CHECKSUM_ALGORITHM)
+        self.closed = threading.Event()
 
+    def read(self, size=-1):
+        buf = self.fp.read(size)
+        self.size += len(buf)
+        self.checksummer.update(buf)
+        return buf
+
+    def close(self):
+        self.fp.close()
+        self.closed.set()
+
+def _compute_segment_metadata(args):
+    """Worker for SegmentStateRebuilder.compute_metadata_all."""
+    return SegmentStateRebuilder().compute_metadata(*args)
 
 class SegmentStateRebuilder(object):
     """Reconstructs segment metadata files from raw segment data."""
 
+    # Number of segment files ahead of the current one for which reads are
+    # requested from the kernel in advance.
+    PREFETCH_DEPTH = 32
+
+    # Size of reads from segment files.
+    BLOCK_SIZE = 1 << 20
+
     def __init__(self):
         self.filters = dict(cumulus.SEGMENT_FILTERS)
         self.segment_pattern = cumulus.SEARCH_PATHS["segments"]
 
+    def prefetch(self, path):
+        """Ask the kernel to start reading a segment file in the background.
+
+        Issuing this for upcoming segments keeps several reads in flight while
+        the current segment is being checksummed and decompressed.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            advise(fd, "POSIX_FADV_WILLNEED")
+        finally:
+            os.close(fd)
+
+    def compute_metadata_all(self, files, topdir, processes=1):
+        """Recompute metadata for a sequence of files below topdir.
+
+        Yields the metadata dictionary for each file recognized as a segment,
+        in the order of files.  If processes is not 1, segments are processed
+        in parallel by a pool of that many worker processes (None selects
+        one per CPU).
+        """
+        files = list(files)
+        if processes != 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                work = [(f, os.path.relpath(f, topdir)) for f in files]
+                for metadata in pool.imap(_compute_segment_metadata, work):
+                    if metadata:
+                        yield metadata
+            finally:
+                pool.terminate()
+                pool.join()
+            return
+
+        for f in files[:self.PREFETCH_DEPTH]:
+            self.prefetch(f)
+        for (i, f) in enumerate(files):
+            if i + self.PREFETCH_DEPTH < len(files):
+                self.prefetch(files[i + self.PREFETCH_DEPTH])
+            metadata = self.compute_metadata(f, os.path.relpath(f, topdir))
+            if metadata:
+                yield metadata
+
     def compute_metadata(self, path, relative_path):
         """Recompute metadata of a single segment.
 
@@ -398,28 +715,38 @@ class SegmentStateRebuilder(object):
         timestamp = time.strftime(SQLITE_TIMESTAMP,
                                   time.gmtime(st_buf.st_mtime))
 
-        # Compute attributes of the compressed segment data.
-        BLOCK_SIZE = 4096
-        with open(path) as segment:
-            disk_size = 0
-            checksummer = cumulus.ChecksumCreator(CHECKSUM_ALGORITHM)
-            while True:
-                buf = segment.read(BLOCK_SIZE)
-                if len(buf) == 0: break
-                disk_size += len(buf)
-                checksummer.update(buf)
-        checksum = checksummer.compute()
-
-        # Compute attributes of the objects within the segment.
+        # Compute attributes of the compressed segment data and of the
+        # objects within the segment in a single pass: the data is checksummed
+        # as it is read by the decompressor.
         data_size = 0
         object_count = 0
-        with open(path) as segment:
-            decompressed = cumulus.CumulusStore.filter_data(segment, filter_cmd)
+        with open(path, "rb") as segment:
+            advise(segment.fileno(), "POSIX_FADV_SEQUENTIAL")
+            reader = _ChecksummingReader(segment)
+            decompressed = cumulus.CumulusStore.filter_data(reader, filter_cmd)
             objects = tarfile.open(mode='r|', fileobj=decompressed)
             for tarinfo in objects:
                 data_size += tarinfo.size
                 object_count += 1
 
+            # Consume any trailing data, so that all of the segment is fed
+            # through the decompressor and the checksum.
+            while len(decompressed.read(self.BLOCK_SIZE)) > 0:
+                pass
+
+        # The filter's copy thread closes the reader after passing along all
+        # input, before the end of the decompressed output is seen.  If the
+        # reader was not closed, the filter stopped early, so fall back to
+        # reading the segment separately for the checksum.
+        if filter_cmd is None or reader.closed.is_set():
+            (checksum, disk_size) = (reader.checksummer.compute(), reader.size)
+        else:
+            reader = _ChecksummingReader(open(path, "rb"))
+            while len(reader.read(self.BLOCK_SIZE)) > 0:
+                pass
+            reader.close()
+            (checksum, disk_size) = (reader.checksummer.compute(), reader.size)
+
         return {"segment": util.uri_encode_pathname(segment_name),
                 "path": util.uri_encode_pathname(relative_path),
                 "checksum": checksum,
@@ -437,14 +764,11 @@ if __name__ == "__main__":
             for f in filenames:
                 files.append(os.path.join(dirpath, f))
         files.sort()
-        for f in files:
-            metadata = segment_rebuilder.compute_metadata(
-                f,
-                os.path.relpath(f, topdir))
-            if metadata:
-                for (k, v) in sorted(metadata.items()):
-                    print("%s: %s" % (k, v))
-                print()
+        for metadata in segment_rebuilder.compute_metadata_all(
+                files, topdir, processes=None):
+            for (k, v) in sorted(metadata.items()):
+                print("%s: %s" % (k, v))
+            print()
         sys.exit(0)
 
     # Sample code to rebuild the segments table from metadata--needs to be
@@ -25,11 +25,36 @@ weekly snapshots going back further in time.
 
 from __future__ import division, print_function, unicode_literals
 
-import calendar
 import datetime
+import re
 
 TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S"
 
+# Fast path for parsing timestamps in TIMESTAMP_FORMAT; anything else is left
+# to strptime.
+_TIMESTAMP_RE = re.compile(r"^(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})(\d{2})\Z")
+
+# Previously parsed timestamps, since the same snapshot names tend to be
+# parsed over and over, mapped to (datetime, Unix time) pairs.  Cleared once it
+# reaches _TIMESTAMP_CACHE_SIZE entries.
+_timestamp_cache = {}
+_TIMESTAMP_CACHE_SIZE = 4096
+
+# datetime.date(1970, 1, 1).toordinal()
+_EPOCH_ORDINAL = 719163
+
+def _unixtime(t):
+    """Convert a naive UTC datetime to integer seconds since the epoch.
+
+    Equivalent to calendar.timegm(t.timetuple()), but much cheaper.
+    """
+    return ((t.toordinal() - _EPOCH_ORDINAL) * 86400
+            + t.hour * 3600 + t.minute * 60 + t.second)
+
+def _microseconds(delta):
+    """Convert a timedelta to an integer number of microseconds."""
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
 # Different classes of backups--such as "daily" or "monthly"--can have
 # different retention periods applied.  A single backup snapshot might belong
 # to multiple classes (i.e., perhaps be both a "daily" and a "monthly", though
@@ -65,10 +90,16 @@ def add_backup_class(name, partioning_function):
     """
     _backup_classes[name] = partioning_function
 
-add_backup_class("yearly", lambda t: t.date().replace(day=1, month=1))
-add_backup_class("monthly", lambda t: t.date().replace(day=1))
-add_backup_class("weekly", lambda t: t.isocalendar()[0:2])
-add_backup_class("daily", lambda t: t.date())
+# The predefined classes use plain integers as partition representatives,
+# which are cheaper to compute and compare than truncated dates.  Ordinal day
+# 1 (January 1 of year 1) is a Monday, so grouping ordinals by seven gives
+# ISO (Monday-based) weeks.  Each is a single C-level call plus a little
+# integer arithmetic; when expiring a long list of snapshots they account for
+# only around a tenth of the time, far less than parsing the snapshot names.
+add_backup_class("yearly", lambda t: t.year)
+add_backup_class("monthly", lambda t: t.year * 12 + t.month)
+add_backup_class("weekly", lambda t: (t.toordinal() - 1) // 7)
+add_backup_class("daily", lambda t: t.toordinal())
 add_backup_class("all", lambda t: t)
 
 
@@ -79,11 +110,20 @@ class RetentionEngine(object):
     snapshots to the policy to decide which ones should be kept.
     """
 
+    __slots__ = ('_convert_to_localtime', '_local_offsets', '_policies',
+                 '_last_snapshots', '_compiled_policies', '_now', '_now_us',
+                 '_labels')
+
+    # Granularity, in seconds, at which local time offsets are cached.
+    LOCAL_OFFSET_GRANULARITY = 900
+
     def __init__(self):
         self.set_utc(False)
+        self._local_offsets = {}
         self._policies = {}
         self._last_snapshots = {}
-        self._now = datetime.datetime.utcnow()
+        self._compiled_policies = []
+        self.set_now(datetime.datetime.utcnow())
 
     def set_utc(self, use_utc=True):
         """Perform policy matching with timestamps in UTC.
@@ -101,16 +141,68 @@ class RetentionEngine(object):
         RetentionEngine object was instantiated.
         """
         self._now = timestamp
+        # Snapshot ages are computed in integer microseconds, which is cheaper
+        # than timedelta arithmetic.
+        self._now_us = (_unixtime(timestamp) * 1000000
+                        + timestamp.microsecond)
 
     def add_policy(self, backup_class, retention_period):
         self._policies[backup_class] = retention_period
-        self._last_snapshots[backup_class] = (None, None, False)
+        # The last snapshot in each class is tracked as a list [partition,
+        # snapshot, retain], updated in place by consider_snapshot.
+        self._last_snapshots[backup_class] = [None, None, False]
+
+        # Resolve everything needed per policy once, so that consider_snapshot
+        # need not look anything up by class name.
+        self._compiled_policies = [
+            (name, _backup_classes[name], _microseconds(period),
+             self._last_snapshots[name])
+            for (name, period) in self._policies.items()]
 
     @staticmethod
     def parse_timestamp(s):
         if isinstance(s, datetime.datetime):
             return s
-        return datetime.datetime.strptime(s, TIMESTAMP_FORMAT)
+        return RetentionEngine._parse_timestamp_unixtime(s)[0]
+
+    @staticmethod
+    def _parse_timestamp_unixtime(s):
+        """Parse a timestamp, returning it both as datetime and Unix time."""
+        if isinstance(s, datetime.datetime):
+            return (s, _unixtime(s))
+        parsed = _timestamp_cache.get(s)
+        if parsed is None:
+            m = _TIMESTAMP_RE.match(s)
+            if m:
+                timestamp = datetime.datetime(*[int(x) for x in m.groups()])
+            else:
+                timestamp = datetime.datetime.strptime(s, TIMESTAMP_FORMAT)
+            parsed = (timestamp, _unixtime(timestamp))
+            if len(_timestamp_cache) >= _TIMESTAMP_CACHE_SIZE:
+                _timestamp_cache.clear()
+            _timestamp_cache[s] = parsed
+        return parsed
+
+    def _local_offset(self, unixtime):
+        """Return the offset of local time from UTC at the given time.
+
+        Offsets are computed once per LOCAL_OFFSET_GRANULARITY interval, so
+        converting many timestamps to local time does not need a call to
+        localtime for each.  Returns None if the offset changes within the
+        interval containing unixtime; the caller must then convert the time
+        directly.
+        """
+        interval = unixtime // self.LOCAL_OFFSET_GRANULARITY
+        if interval not in self._local_offsets:
+            def offset_at(t):
+                return (datetime.datetime.fromtimestamp(t)
+                        - datetime.datetime.utcfromtimestamp(t))
+            start = interval * self.LOCAL_OFFSET_GRANULARITY
+            offset = offset_at(start)
+            if offset_at(start + self.LOCAL_OFFSET_GRANULARITY - 1) != offset:
+                offset = None
+            self._local_offsets[interval] = offset
+        return self._local_offsets[interval]
 
     def consider_snapshot(self, snapshot):
         """Compute whether a given snapshot should be expired.
@@ -120,30 +212,51 @@ class RetentionEngine(object):
         boolean indicating whether the snapshot should be retained (True) or
         expired (False).
         """
-        timestamp_utc = self.parse_timestamp(snapshot)
-        snapshot_age = self._now - timestamp_utc
-
-        # timestamp_policy is the timestamp in the format that will be used for
-        # doing policy matching: either in the local timezone or UTC, depending
-        # on the setting of set_utc().
-        if self._convert_to_localtime:
-            unixtime = calendar.timegm(timestamp_utc.timetuple())
-            timestamp_policy = datetime.datetime.fromtimestamp(unixtime)
-        else:
-            timestamp_policy = timestamp_utc
-
-        self._labels = set()
-        retain = False
-        for (backup_class, retention_period) in self._policies.items():
-            partition = _backup_classes[backup_class](timestamp_policy)
-            last_snapshot = self._last_snapshots[backup_class]
-            if self._last_snapshots[backup_class][0] != partition:
-                self._labels.add(backup_class)
-                retain_label = snapshot_age < retention_period
-                self._last_snapshots[backup_class] = (partition, snapshot,
-                                                      retain_label)
-                if retain_label: retain = True
-        return retain
+        return self.consider_snapshots([snapshot])[0]
+
+    def consider_snapshots(self, snapshots):
+        """Compute whether each of a sequence of snapshots should be expired.
+
+        This is equivalent to calling consider_snapshot() for each snapshot in
+        turn, and returns a list of the results, but is faster for long lists
+        of snapshots.
+        """
+        parse_timestamp = self._parse_timestamp_unixtime
+        now_us = self._now_us
+        convert_to_localtime = self._convert_to_localtime
+        policies = self._compiled_policies
+
+        results = []
+        for snapshot in snapshots:
+            (timestamp_utc, unixtime) = parse_timestamp(snapshot)
+            snapshot_age = now_us - (unixtime * 1000000
+                                     + timestamp_utc.microsecond)
+
+            # timestamp_policy is the timestamp in the format that will be used
+            # for doing policy matching: either in the local timezone or UTC,
+            # depending on the setting of set_utc().
+            if convert_to_localtime:
+                offset = self._local_offset(unixtime)
+                if offset is not None:
+                    timestamp_policy = (timestamp_utc.replace(microsecond=0)
+                                        + offset)
+                else:
+                    timestamp_policy = datetime.datetime.fromtimestamp(unixtime)
+            else:
+                timestamp_policy = timestamp_utc
+
+            self._labels = labels = set()
+            retain = False
+            for (backup_class, partition_function, retention_period,
+                 last_snapshot) in policies:
+                partition = partition_function(timestamp_policy)
+                if last_snapshot[0] != partition:
+                    labels.add(backup_class)
+                    retain_label = snapshot_age < retention_period
+                    last_snapshot[:] = (partition, snapshot, retain_label)
+                    if retain_label: retain = True
+            results.append(retain)
+        return results
 
     def last_labels(self):
         """Return the set of policies that applied to the last snapshot.
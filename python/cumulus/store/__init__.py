@@ -19,7 +19,11 @@
 from __future__ import division, print_function, unicode_literals
 
 import importlib
+import io
+import multiprocessing.pool
+import os
 import re
+import time
 try:
     # Python 3
     from urllib import parse as urlparse
@@ -29,20 +33,56 @@ except ImportError:
     from urllib import quote, unquote
     import urlparse
 
+# Backup file names are plain ASCII; re.ASCII (absent on Python 2, where it is
+# the default for byte strings) keeps the character classes cheap to match.
+_RE_FLAGS = getattr(re, "ASCII", 0)
+
 type_patterns = {
-    'checksums': re.compile(r"^snapshot-(.*)\.(\w+)sums$"),
-    'segments': re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(\.\S+)?$"),
-    'snapshots': re.compile(r"^snapshot-(.*)\.(cumulus|lbs)$")
+    'checksums': re.compile(r"^snapshot-(.*)\.(\w+)sums$", _RE_FLAGS),
+    'segments': re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(\.\S+)?$", _RE_FLAGS),
+    'snapshots': re.compile(r"^snapshot-(.*)\.(cumulus|lbs)$", _RE_FLAGS)
 }
 
+# Bound match methods, for callers that test many names against one type.
+match_checksums = type_patterns['checksums'].match
+match_segments = type_patterns['segments'].match
+match_snapshots = type_patterns['snapshots'].match
+
 class NotFoundError(KeyError):
     """Exception thrown when a file is not found in a repository."""
 
     pass
 
+def advise_sequential(fp):
+    """Tell the kernel that the file fp will be read through to the end.
+
+    On Linux this doubles the readahead window, so that the data for the next
+    read is usually in the page cache already.  Ignored for objects without a
+    file descriptor, for pipes, and where posix_fadvise is not available.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        pass
+
 class Store(object):
     """Base class for all cumulus storage backends."""
 
+    # Backends which keep a fixed set of attributes may declare their own
+    # __slots__; an empty tuple here keeps that effective.
+    __slots__ = ()
+
+    # Default number of threads used by get_many and put_many.  Transfers are
+    # I/O bound, so threads overlap them despite the interpreter lock.
+    TRANSFER_THREADS = 8
+
+    # Seconds for which a scan is trusted to name every file in a directory.
+    # Other processes may add files in the meantime, so once a scan has
+    # expired a file missing from it is looked up in the backend again.
+    SCAN_TTL = 60
+
     def __init__(self, url):
         """Initializes a new storage backend.
 
@@ -52,7 +92,11 @@ class Store(object):
         """
         pass
 
-    # TODO: Implement context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def list(self, path):
         raise NotImplementedError
@@ -69,6 +113,44 @@ class Store(object):
     def stat(self, path):
         raise NotImplementedError
 
+    def get_many(self, paths, threads=None):
+        """Open several files at once, returning a list of file objects."""
+        return self._transfer(self.get, paths, threads)
+
+    def put_many(self, items, threads=None):
+        """Store several files at once, given a sequence of (path, fp) pairs.
+
+        The backend is shared between the worker threads, so this is only
+        useful for backends whose put can run concurrently with itself.
+        """
+        return self._transfer(lambda item: self.put(*item), items, threads)
+
+    def delete_many(self, paths, threads=None):
+        """Delete several files at once."""
+        self._transfer(self.delete, paths, threads)
+
+    def stat_many(self, paths, threads=None):
+        """Stat several files at once, returning a list of stat results.
+
+        A cheaper alternative to scan when only a few of the files in a
+        large directory are of interest.
+        """
+        return self._transfer(self.stat, paths, threads)
+
+    def _transfer(self, function, items, threads):
+        items = list(items)
+        if threads is None:
+            threads = self.TRANSFER_THREADS
+        threads = min(threads, len(items))
+        if threads <= 1:
+            return [function(item) for item in items]
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
     def scan(self, path):
         """Cache file information stored in this backend.
 
@@ -77,19 +159,45 @@ class Store(object):
 
         pass
 
+    def _scan_is_fresh(self, scanned):
+        """Whether a scan made at time scanned can still be trusted.
+
+        scanned is a time.time() value, or None if there was no scan.
+        """
+        return scanned is not None and time.time() - scanned < self.SCAN_TTL
+
     def close(self):
         """Tear down the connection explicitly if needed
 
-        Currently needed for sftp to be able to end the program."""
+        Stores can also be used as context managers, which close them on exit.
+        There is no __del__ calling close(); backends holding resources that
+        must be released eventually arrange for that themselves."""
 
         pass
 
-    def __del__(self):
-        self.close()
+_urlsplit = urlparse.urlsplit
+
+# Store classes for schemes already opened, keyed by URL scheme.
+_backends = {}
+
+_SCHEME_RE = re.compile(r"^\w+$", _RE_FLAGS)
+
+def _get_backend(scheme):
+    """Return the Store class for a URL scheme, importing it on first use.
+
+    Raises ImportError if no backend module exists for the scheme."""
+
+    backend = _backends.get(scheme)
+    if backend is None:
+        if not _SCHEME_RE.match(scheme):
+            raise ImportError("Invalid scheme %s" % scheme)
+        handler = importlib.import_module("cumulus.store.%s" % scheme)
+        backend = _backends[scheme] = handler.Store
+    return backend
 
 def open(url):
     """Parse a storage url, then locate and initialize a backend for it."""
-    parsed_url = urlparse.urlsplit(url)
+    parsed_url = _urlsplit(url)
 
     # If there is no scheme, fall back to treating the string as local path and
     # construct a file:/// URL.
@@ -98,13 +206,9 @@ def open(url):
 
     try:
         # TODO: Support a registry for schemes that don't map to a module.
-        if re.match(r"^\w+$", parsed_url.scheme):
-            handler = importlib.import_module("cumulus.store.%s" %
-                                              parsed_url.scheme)
-            obj = handler.Store(parsed_url)
-            return obj
+        return _get_backend(parsed_url.scheme)(parsed_url)
     except ImportError:
         # Fall through to error below
         pass
 
-    raise NotImplementedError("Scheme %s not implemented" % scheme)
+    raise NotImplementedError("Scheme %s not implemented" % parsed_url.scheme)
@@ -18,41 +18,156 @@
 
 from __future__ import division, print_function, unicode_literals
 
-import os, sys, tempfile
+import errno, io, os, shutil, stat, sys, tempfile, time
 
 import cumulus.store
 
+# Buffer size used when copying data which cannot be passed to sendfile.
+COPY_BUFFER_SIZE = 1 << 20
+
 class Store(cumulus.store.Store):
     """Storage backend that accesses the local file system."""
+
+    __slots__ = ('prefix', '_path_prefix', 'scan_cache',
+                 '_scanned_directories')
+
     def __init__(self, url):
         super(Store, self).__init__(url)
         self.prefix = cumulus.store.unquote(url.path)
+        # The prefix with exactly one trailing separator, so that paths can
+        # be built by plain concatenation.
+        self._path_prefix = os.path.join(self.prefix, "")
+
+        # File sizes found by scan, keyed by full path, and the directories
+        # (with trailing separator) which have been scanned, mapped to the
+        # time of the scan.  Any file missing from the cache in a directory
+        # scanned less than SCAN_TTL seconds ago does not exist.
+        self.scan_cache = {}
+        self._scanned_directories = {}
+
+    def _get_path(self, path):
+        return self._path_prefix + path
+
+    def scan(self, path):
+        directory = os.path.join(self._get_path(path), "")
+        try:
+            if hasattr(os, "scandir"):
+                for entry in os.scandir(directory):
+                    if entry.is_file():
+                        self.scan_cache[directory + entry.name] = \
+                            entry.stat().st_size
+            else:
+                for name in os.listdir(directory):
+                    st = os.stat(directory + name)
+                    if stat.S_ISREG(st.st_mode):
+                        self.scan_cache[directory + name] = st.st_size
+        except OSError as e:
+            # Scanning is only an optimization, so ignore errors; but a
+            # directory which does not exist is known to contain no files.
+            if e.errno != errno.ENOENT:
+                return
+        self._scanned_directories[directory] = time.time()
+
+    def _is_scanned(self, fullpath):
+        directory = fullpath.rpartition("/")[0] + "/"
+        return self._scan_is_fresh(self._scanned_directories.get(directory))
 
     def list(self, subdir):
         try:
-            return os.listdir(os.path.join(self.prefix, subdir))
+            return os.listdir(self._get_path(subdir))
         except OSError:
             raise cumulus.store.NotFoundError(subdir)
 
     def get(self, path):
         try:
-            return open(os.path.join(self.prefix, path), "rb")
+            return open(self._get_path(path), "rb")
         except IOError:
             raise cumulus.store.NotFoundError(path)
 
     def put(self, path, fp):
-        with open(os.path.join(self.prefix, path), "wb") as out:
-            buf = fp.read(4096)
-            while len(buf) > 0:
-                out.write(buf)
-                buf = fp.read(4096)
+        fullpath = self._get_path(path)
+        with open(fullpath, "wb", COPY_BUFFER_SIZE) as out:
+            preallocated = self._preallocate(fp, out)
+            if not self._sendfile(fp, out):
+                shutil.copyfileobj(fp, out, COPY_BUFFER_SIZE)
+            if preallocated:
+                # Drop any allocated space beyond what was actually copied,
+                # should the source have shrunk in the meantime.
+                out.flush()
+                fd = out.fileno()
+                os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+        if self._is_scanned(fullpath):
+            self.scan_cache[fullpath] = os.stat(fullpath).st_size
+
+    @staticmethod
+    def _preallocate(src, dst):
+        """Reserve space in dst for the rest of src, if its size is known.
+
+        Allocating the whole file up front lets the file system lay it out in
+        as few extents as possible.  Returns True if space was allocated.
+        """
+        if not hasattr(os, "posix_fallocate"):
+            return False
+        try:
+            src_stat = os.fstat(src.fileno())
+            if not stat.S_ISREG(src_stat.st_mode):
+                return False
+            size = src_stat.st_size - src.tell()
+            if size <= 0:
+                return False
+            os.posix_fallocate(dst.fileno(), 0, size)
+        except (AttributeError, io.UnsupportedOperation, OSError):
+            return False
+        return True
+
+    @staticmethod
+    def _sendfile(src, dst):
+        """Copy the rest of src to dst within the kernel, if possible.
+
+        Returns False, without having copied anything, if src or dst is not a
+        regular file or the platform does not support this; the caller must
+        then copy the data itself.
+        """
+        if not hasattr(os, "sendfile"):
+            return False
+        try:
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return False
+        src_stat = os.fstat(src_fd)
+        if not stat.S_ISREG(src_stat.st_mode):
+            return False
+        offset = src.tell()
+        size = src_stat.st_size
+        first = True
+        while offset < size:
+            try:
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+            except OSError as e:
+                if first and e.errno in (errno.EINVAL, errno.ENOSYS,
+                                         errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    return False
+                raise
+            if sent == 0:
+                break
+            offset += sent
+            first = False
+        src.seek(offset)
+        return True
 
     def delete(self, path):
-        os.unlink(os.path.join(self.prefix, path))
+        fullpath = self._get_path(path)
+        self.scan_cache.pop(fullpath, None)
+        os.unlink(fullpath)
 
     def stat(self, path):
+        fullpath = self._get_path(path)
+        if fullpath in self.scan_cache:
+            return {'size': self.scan_cache[fullpath]}
+        if self._is_scanned(fullpath):
+            raise cumulus.store.NotFoundError(path)
         try:
-            stat = os.stat(os.path.join(self.prefix, path))
+            stat = os.stat(fullpath)
             return {'size': stat.st_size}
         except OSError:
             raise cumulus.store.NotFoundError(path)
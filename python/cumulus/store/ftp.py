@@ -18,13 +18,442 @@
 
 from __future__ import division, print_function, unicode_literals
 
-from ftplib        import FTP, all_errors, error_temp
+import atexit
+import contextlib
+import ftplib
+import functools
+import io
+import posixpath
+import socket
+import threading
+import time
+import weakref
+from ftplib        import FTP, all_errors, error_perm, error_reply, error_temp
 from netrc         import netrc, NetrcParseError
-from cumulus.store import Store, type_patterns, NotFoundError
+from six.moves     import queue
+from cumulus.store import Store, NotFoundError, urlparse
+from cumulus.store import advise_sequential
+
+def is_missing (err):
+    """ Most servers answer 550 for commands on files that don't exist """
+    return isinstance (err, error_perm) and str (err).startswith ('550')
+# end def is_missing
+
+# TCP keepalive settings for control connections, options the platform
+# doesn't have are skipped
+TCP_KEEPALIVE = \
+    (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 20), ('TCP_KEEPCNT', 3))
+
+def set_keepalive (sock):
+    """ Let the kernel probe an idle connection, so that NAT gateways
+        and firewalls on the way don't forget about it
+    """
+    sock.setsockopt (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt, value in TCP_KEEPALIVE:
+        if hasattr (socket, opt):
+            sock.setsockopt (socket.IPPROTO_TCP, getattr (socket, opt), value)
+# end def set_keepalive
+
+class PipelinedFTP (FTP):
+    """ FTP client that can send several commands before waiting for
+        the replies, saving a round trip per additional command.
+        It also remembers the transfer type and doesn't send a TYPE
+        command that wouldn't change it, this includes those sent
+        internally by ftplib. Passive mode prefers EPSV over PASV.
+    """
+
+    UNCHANGED = '200 Type unchanged'
+
+    # Transfer type last set on this connection, None if unknown
+    current_type = None
+
+    # Use EPSV for passive transfers over IPv4 too: The reply only has
+    # the port, so a wrong address from a server behind NAT does no
+    # harm. Cleared on the first rejection, we then fall back to PASV.
+    use_epsv = True
+
+    def connect (self, *args, **kw):
+        self.current_type = None
+        return FTP.connect (self, *args, **kw)
+    # end def connect
+
+    def _type_unchanged (self, cmd):
+        return cmd [:5] == 'TYPE ' and cmd [5:] == self.current_type
+    # end def _type_unchanged
+
+    def _note_type (self, cmd):
+        if cmd [:5] == 'TYPE ':
+            self.current_type = cmd [5:]
+    # end def _note_type
+
+    def sendcmd (self, cmd):
+        if self._type_unchanged (cmd):
+            return self.UNCHANGED
+        resp = FTP.sendcmd (self, cmd)
+        self._note_type (cmd)
+        return resp
+    # end def sendcmd
+
+    def voidcmd (self, cmd):
+        if self._type_unchanged (cmd):
+            return self.UNCHANGED
+        resp = FTP.voidcmd (self, cmd)
+        self._note_type (cmd)
+        return resp
+    # end def voidcmd
+
+    def pipeline (self, cmds):
+        """ Send all cmds, then read their replies in order. A failed
+            reply is returned as its exception instead of raised, so
+            that the remaining replies are still read.
+        """
+        sent = [not self._type_unchanged (cmd) for cmd in cmds]
+        for cmd, s in zip (cmds, sent):
+            if s:
+                self.putcmd (cmd)
+        resps = []
+        for cmd, s in zip (cmds, sent):
+            if not s:
+                resps.append (self.UNCHANGED)
+                continue
+            try :
+                resps.append (self.getresp ())
+                self._note_type (cmd)
+            except ftplib.Error as err :
+                resps.append (err)
+        return resps
+    # end def pipeline
+
+    def _pasv_address (self, resp):
+        """ Data connection address from a 229 (EPSV) or 227 (PASV) reply """
+        peer = self.sock.getpeername ()
+        if resp [:3] == '229':
+            return ftplib.parse229 (resp, peer)
+        host, port = ftplib.parse227 (resp)
+        if not getattr (self, 'trust_server_pasv_ipv4_address', True):
+            host = peer [0]
+        return host, port
+    # end def _pasv_address
+
+    def makepasv (self):
+        if self.use_epsv:
+            try :
+                return self._pasv_address (self.sendcmd ('EPSV'))
+            except error_perm :
+                if self.af != socket.AF_INET:
+                    raise
+                self.use_epsv = False
+        return self._pasv_address (self.sendcmd ('PASV'))
+    # end def makepasv
+
+    def typed_transfercmd (self, type_cmd, cmd):
+        """ Like transfercmd (cmd) preceded by type_cmd, but in passive
+            mode the type and the PASV/EPSV command share a round trip.
+        """
+        if not self.passiveserver:
+            self.voidcmd (type_cmd)
+            return self.transfercmd (cmd)
+        pasv_cmd = 'EPSV' if self.use_epsv else 'PASV'
+        type_resp, resp = self.pipeline ([type_cmd, pasv_cmd])
+        if isinstance (type_resp, Exception):
+            raise type_resp
+        if type_resp [:1] != '2':
+            raise error_reply (type_resp)
+        if isinstance (resp, error_perm) and pasv_cmd == 'EPSV' \
+           and self.af == socket.AF_INET:
+            self.use_epsv = False
+            host, port = self.makepasv ()
+        elif isinstance (resp, Exception):
+            raise resp
+        else:
+            host, port = self._pasv_address (resp)
+        conn = socket.create_connection ((host, port), self.timeout)
+        try :
+            resp = self.sendcmd (cmd)
+            # Some servers apparently send a 200 reply to a RETR before
+            # the 150 reply, see ftplib.FTP.ntransfercmd
+            if resp [0] == '2':
+                resp = self.getresp ()
+            if resp [0] != '1':
+                raise error_reply (resp)
+        except :
+            conn.close ()
+            raise
+        return conn
+    # end def typed_transfercmd
+
+# end class PipelinedFTP
+
+class FtpConnection (object):
+    """ One control connection to the server, with its sync state """
+
+    # Seconds after which an idle connection is checked before use
+    IDLE_CHECK = 30
+
+    def __init__ (self, host, port, user, passwd, prefix):
+        self.host   = host
+        self.port   = port
+        self.user   = user
+        self.passwd = passwd
+        self.prefix = prefix
+        self.ftp    = PipelinedFTP ()
+        self.synced = True
+        self.has_mlsd = False
+        self.last_used = time.time ()
+        self.connect ()
+    # end def __init__
+
+    def connect (self) :
+        self.ftp.connect (self.host, self.port)
+        set_keepalive (self.ftp.sock)
+        self.ftp.login (self.user, self.passwd)
+        self.has_mlsd = self.probe_mlsd ()
+        self.ftp.cwd (self.prefix)
+    # end def connect
+
+    def probe_mlsd (self):
+        """ Ask the server with FEAT whether it supports MLSD (RFC 3659
+            advertises it as MLST). If so, restrict listings to the
+            facts we need.
+        """
+        try :
+            features = self.ftp.sendcmd ('FEAT').splitlines () [1:-1]
+        except all_errors :
+            return False
+        if not any (f.strip ().upper ().startswith ('MLST') for f in features):
+            return False
+        try :
+            self.ftp.sendcmd ('OPTS MLST type;size;')
+        except all_errors :
+            pass
+        return True
+    # end def probe_mlsd
+
+    def mlsd (self, path = ''):
+        """ List path (default the current directory) with MLSD, return
+            a dict mapping each plain file to its size.
+        """
+        sizes = {}
+        def entry (line):
+            facts, _, name = line.partition (' ')
+            facts = dict \
+                ( f.split ('=', 1) for f in facts.lower ().split (';')
+                  if '=' in f
+                )
+            if facts.get ('type') == 'file' and 'size' in facts:
+                sizes [name] = int (facts ['size'])
+        self.ftp.retrlines ('MLSD %s' % path if path else 'MLSD', entry)
+        return sizes
+    # end def mlsd
+
+    def sync (self):
+        """ After a get command at end of transfer a 2XX reply is still
+        in the input-queue, we have to get rid of that.
+        If the connection has been idle for IDLE_CHECK seconds we also
+        test here that it is still alive. If we get a temporary error
+        421 ("error_temp") we reconnect: It was probably a timeout.
+        """
+        try :
+            if not self.synced:
+                try :
+                    self.ftp.voidresp()
+                except (error_temp, error_perm) as err :
+                    # The transfer was aborted, a file from get was
+                    # closed before it had been read completely
+                    if str (err) [:3] not in ('426', '451') :
+                        raise
+            if time.time () - self.last_used > self.IDLE_CHECK:
+                self.ftp.voidcmd ('NOOP')
+        except error_temp as err :
+            if not str (err).startswith ('421') :
+                raise
+            self.connect ()
+        self.synced    = True
+        self.last_used = time.time ()
+    # end def sync
+
+    def close (self):
+        try :
+            self.ftp.quit ()
+        except all_errors :
+            self.ftp.close ()
+    # end def close
+
+# end class FtpConnection
+
+class ConnectionPool (object):
+    """ A bounded pool of connections, created on demand by factory.
+        At most maxsize connections are handed out at a time, further
+        callers of acquire or item block until one is returned.
+        If keepalive is given, a background thread syncs the idle
+        connections every keepalive seconds, this sends a NOOP to
+        those idle for longer than IDLE_CHECK before the server times
+        them out. The thread only holds a weak reference to the pool and
+        ends once the pool is closed or garbage collected.
+    """
+
+    def __init__ (self, factory, maxsize, keepalive = None):
+        self.factory = factory
+        self.idle    = queue.LifoQueue ()
+        self.slots   = threading.BoundedSemaphore (maxsize)
+        self.stopped = threading.Event ()
+        if keepalive:
+            t = threading.Thread \
+                ( target = self._keepalive
+                , args   = (weakref.ref (self), self.stopped, keepalive)
+                )
+            t.daemon = True
+            t.start ()
+    # end def __init__
+
+    @staticmethod
+    def _keepalive (pool_ref, stopped, interval):
+        while not stopped.wait (interval):
+            pool = pool_ref ()
+            if pool is None:
+                break
+            pool.refresh ()
+            del pool
+    # end def _keepalive
+
+    def refresh (self):
+        """ Sync the idle connections, not waiting for busy slots """
+        conns = []
+        while self.slots.acquire (False):
+            try :
+                conns.append (self.idle.get_nowait ())
+            except queue.Empty :
+                self.slots.release ()
+                break
+        for conn in conns:
+            try :
+                conn.sync ()
+            except all_errors :
+                self.release (conn, broken = True)
+            else :
+                self.release (conn)
+    # end def refresh
+
+    def acquire (self):
+        """ Take a synced connection out of the pool, each call must be
+            paired with a release.
+        """
+        self.slots.acquire ()
+        conn = None
+        try :
+            try :
+                conn = self.idle.get_nowait ()
+            except queue.Empty :
+                pass
+            if conn is not None :
+                try :
+                    conn.sync ()
+                except (socket.error, EOFError) :
+                    # The idle connection was dropped by the server or
+                    # the network, replace it
+                    conn.ftp.close ()
+                    conn = None
+            if conn is None :
+                conn = self.factory ()
+        except :
+            if conn is not None :
+                conn.ftp.close ()
+            self.slots.release ()
+            raise
+        return conn
+    # end def acquire
+
+    def release (self, conn, broken = False):
+        """ Give conn back, a broken connection is closed instead """
+        if broken :
+            conn.ftp.close ()
+        else :
+            self.idle.put (conn)
+        self.slots.release ()
+    # end def release
+
+    @contextlib.contextmanager
+    def item (self):
+        """ Lend out a synced connection for the duration of a with-block.
+            A connection that failed with a socket error is discarded.
+        """
+        conn   = self.acquire ()
+        broken = False
+        try :
+            yield conn
+        except (socket.error, EOFError) :
+            broken = True
+            raise
+        finally :
+            self.release (conn, broken)
+    # end def item
+
+    def close (self):
+        self.stopped.set ()
+        while True:
+            try :
+                conn = self.idle.get_nowait ()
+            except queue.Empty :
+                break
+            conn.close ()
+    # end def close
+
+# end class ConnectionPool
+
+class FtpDataChannel (io.RawIOBase):
+    """ Raw reader for the data connection of a RETR. The control
+        connection stays out of the pool until all data has been read
+        or the reader is closed, sync then reads the transfer reply.
+    """
+
+    def __init__ (self, sock, conn, pool):
+        self.sock = sock
+        self.conn = conn
+        self.pool = pool
+    # end def __init__
+
+    def readable (self):
+        return True
+    # end def readable
+
+    def readinto (self, b):
+        if self.conn is None:
+            return 0
+        n = self.sock.recv_into (b)
+        if not n:
+            self.finish ()
+        return n
+    # end def readinto
+
+    def finish (self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        self.sock.close ()
+        conn.synced = False
+        self.pool.release (conn)
+    # end def finish
+
+    def close (self):
+        self.finish ()
+        io.RawIOBase.close (self)
+    # end def close
+
+# end class FtpDataChannel
 
 class FtpStore (Store):
+
+    # Number of control connections if not given with ?pool=N in the url
+    POOL_SIZE = 4
+    # Buffer size for reading files returned by get
+    GET_BUFFER_SIZE = 1 << 20
+    # Seconds between keepalive checks of idle connections if not given
+    # with ?keepalive=N in the url, 0 turns them off
+    KEEPALIVE = 60
+
     def __init__ (self, url, **kw):
-        self.synced = True
+        self.netloc = url.netloc
+        self.path   = url.path
         try:
             upw, hp = self.netloc.split ('@')
         except ValueError:
@@ -54,78 +483,192 @@ class FtpStore (Store):
         self.user   = user
         self.passwd = passwd
         self.prefix = self.path [1:] # skip *only* first '/'
-        self.ftp    = FTP ()
-        self.connect ()
+        query       = urlparse.parse_qs (url.query)
+        pool_size   = int (query.get ('pool', [self.POOL_SIZE]) [0])
+        keepalive   = float (query.get ('keepalive', [self.KEEPALIVE]) [0])
+        # Parallel transfers beyond the number of connections would block
+        self.TRANSFER_THREADS = pool_size
+        # File sizes from MLSD listings and from stat, keyed by path, and
+        # the directories which have been listed completely, mapped to the
+        # time of the listing. Any file missing from the cache in a
+        # directory listed less than SCAN_TTL seconds ago does not exist.
+        self.scan_cache = {}
+        self._scanned_directories = {}
+        # The factory must not refer back to the store, otherwise the
+        # pool would keep it from being garbage collected
+        factory     = functools.partial \
+            (FtpConnection, host, port, user, passwd, self.prefix)
+        self.pool   = ConnectionPool (factory, pool_size, keepalive)
+        # Idle connections are closed once the store is garbage collected
+        # or at the latest when the interpreter exits
+        if hasattr (weakref, 'finalize'):
+            self._finalizer = weakref.finalize (self, self.pool.close)
+        else:
+            self._finalizer = self.pool.close
+            atexit.register (self._finalizer)
+        # Connect once right away so that bad urls are reported early
+        with self.pool.item ():
+            pass
+    # end def __init__
 
-    def _get_path (self, type, name):
-        # we are in right directory
-        return name
+    def _get_path (self, path):
+        # we are in right directory, paths are relative to it
+        return path
+    # end def _get_path
 
-    def connect (self) :
-        self.ftp.connect (self.host, self.port)
-        self.ftp.login (self.user, self.passwd)
-        self.ftp.cwd (self.prefix)
-    # end def connect
+    def _scanned_directory (self, directory, sizes):
+        # Forget files of an earlier listing, list serves the names too
+        for path in [p for p in self.scan_cache
+                     if posixpath.dirname (p) == directory
+                    ]:
+            del self.scan_cache [path]
+        for name, size in sizes.items ():
+            self.scan_cache [posixpath.join (directory, name)] = size
+        self._scanned_directories [directory] = time.time ()
+    # end def _scanned_directory
 
-    def list (self, type):
-        self.sync ()
-        files = self.ftp.nlst ()
-        return (f for f in files if type_patterns[type].match (f))
-
-    def get (self, type, name):
-        self.sync ()
-        self.ftp.sendcmd ('TYPE I')
-        sock = self.ftp.transfercmd ('RETR %s' % self._get_path (type, name))
-        self.synced = False
-        return sock.makefile ()
-
-    def put (self, type, name, fp):
-        self.sync ()
-        self.ftp.storbinary ("STOR %s" % self._get_path (type, name), fp)
-
-    def delete (self, type, name):
-        self.sync ()
-        self.ftp.delete (self._get_path (type, name))
-
-    def stat (self, type, name):
-        """ Note that the size-command is non-standard but supported by
-        most ftp servers today. If size returns an error condition we
-        try nlst to detect if the file exists and return an bogus length
+    def _is_scanned (self, path):
+        return self._scan_is_fresh \
+            (self._scanned_directories.get (posixpath.dirname (path)))
+    # end def _is_scanned
+
+    def scan (self, path):
+        directory = path.strip ('/')
+        with self.pool.item () as c:
+            if not c.has_mlsd:
+                return
+            try:
+                sizes = c.mlsd (self._get_path (directory))
+            except error_perm as err:
+                # Scanning is only an optimization, but a directory which
+                # does not exist is known to contain no files.
+                if not is_missing (err):
+                    return
+                sizes = {}
+        self._scanned_directory (directory, sizes)
+    # end def scan
+
+    def list (self, path):
+        """ A directory is listed with MLSD and then served from the
+            scan cache for SCAN_TTL seconds or until a put changes it.
         """
-        self.sync ()
-        fn = self._get_path (type, name)
-        size = None
+        directory = path.strip ('/')
+        if self._scan_is_fresh (self._scanned_directories.get (directory)):
+            prefix = posixpath.join (directory, '')
+            return [ p [len (prefix):] for p in self.scan_cache
+                     if posixpath.dirname (p) == directory
+                   ]
+        with self.pool.item () as c:
+            try:
+                if c.has_mlsd:
+                    sizes = c.mlsd (self._get_path (directory))
+                else:
+                    files = c.ftp.nlst (self._get_path (directory))
+            except error_perm as err:
+                if is_missing (err):
+                    raise NotFoundError(path)
+                raise
+        if not c.has_mlsd:
+            # Some servers include the directory in the names
+            return [posixpath.basename (f) for f in files]
+        self._scanned_directory (directory, sizes)
+        return list (sizes)
+    # end def list
+
+    def get (self, path):
+        """ The returned file holds on to a connection of the pool until
+            it has been read to the end or closed.
+        """
+        c = self.pool.acquire ()
         try:
+            sock = c.ftp.typed_transfercmd \
+                ('TYPE I', 'RETR %s' % self._get_path (path))
+        except error_perm as err:
+            self.pool.release (c)
+            if is_missing (err):
+                raise NotFoundError(path)
+            raise
+        except (socket.error, EOFError):
+            self.pool.release (c, broken = True)
+            raise
+        except:
+            self.pool.release (c)
+            raise
+        return io.BufferedReader \
+            (FtpDataChannel (sock, c, self.pool), self.GET_BUFFER_SIZE)
+    # end def get
+
+    def get_many (self, paths, threads = None):
+        """ Files from get hold on to their connection, so returning
+            more of them than the pool has connections would block
+            forever: the files are read into memory instead.
+        """
+        def fetch (path):
+            with self.get (path) as f:
+                return io.BytesIO (f.read ())
+        return self._transfer (fetch, paths, threads)
+    # end def get_many
+
+    def put (self, path, fp):
+        advise_sequential (fp)
+        with self.pool.item () as c:
+            c.ftp.storbinary ("STOR %s" % self._get_path (path), fp)
+        # The size stored is not known here, let stat ask the server
+        self.scan_cache.pop (path, None)
+        self._scanned_directories.pop (posixpath.dirname (path), None)
+    # end def put
+
+    def delete (self, path):
+        with self.pool.item () as c:
+            try:
+                c.ftp.delete (self._get_path (path))
+            except error_perm as err:
+                if is_missing (err):
+                    raise NotFoundError(path)
+                raise
+        self.scan_cache.pop (path, None)
+    # end def delete
+
+    def stat (self, path):
+        """ Sizes are taken from the last directory listing if the server
+            supports MLSD or from an earlier stat. Otherwise note that the
+            size-command is non-standard but supported by most ftp servers
+            today. If size returns an error condition we try nlst to detect
+            if the file exists and return an bogus length, except for 550
+            which we take to mean the file is missing
+        """
+        if path in self.scan_cache:
+            return {'size': self.scan_cache [path]}
+        if self._is_scanned (path):
+            raise NotFoundError(path)
+        fn = self._get_path (path)
+        size = None
+        with self.pool.item () as c:
             # my client doesn't accept size in ascii-mode
-            self.ftp.sendcmd ('TYPE I')
-            size = self.ftp.size (fn)
-            self.ftp.sendcmd ('TYPE A')
-        except all_errors as err:
-            print(err)
-            pass
-        if size is not None:
-            return {'size': size}
-        print("nlst: %s" % fn, size)
-        l = self.ftp.nlst (fn)
+            resp = c.ftp.pipeline (['TYPE I', 'SIZE %s' % fn]) [1]
+            if isinstance (resp, Exception):
+                if is_missing (resp):
+                    raise NotFoundError(path)
+                print(resp)
+            elif resp [:3] == '213':
+                size = int (resp [3:].strip ())
+            if size is not None:
+                self.scan_cache [path] = size
+                return {'size': size}
+            print("nlst: %s" % fn, size)
+            try:
+                l = c.ftp.nlst (fn)
+            except error_perm as err:
+                if not is_missing (err):
+                    raise
+                l = []
         if l:
             return {'size': 42}
-        raise NotFoundError(type, name)
+        raise NotFoundError(path)
+    # end def stat
 
-    def sync (self):
-        """ After a get command at end of transfer a 2XX reply is still
-        in the input-queue, we have to get rid of that.
-        We also test here that the connection is still alive. If we get
-        a temporary error 421 ("error_temp") we reconnect: It was
-        probably a timeout.
-        """
-        try :
-            if not self.synced:
-                self.ftp.voidresp()
-            self.ftp.sendcmd ('TYPE A')
-        except error_temp as err :
-            if not err.message.startswith ('421') :
-                raise
-            self.connect ()
-        self.synced = True
+    def close (self):
+        self._finalizer ()
+    # end def close
 
 Store = FtpStore
@@ -20,36 +20,100 @@
 
 from __future__ import division, print_function, unicode_literals
 
-import os, sys, tempfile
-import boto
-from boto.exception import S3ResponseError
-from boto.s3.bucket import Bucket
-from boto.s3.key import Key
+import io
+import multiprocessing.pool
+import os, sys, time
+import boto3.session
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 import cumulus.store
 
-def throw_notfound(method):
-    """Decorator to convert a 404 error into a cumulus.store.NoutFoundError."""
-    def f(*args, **kwargs):
-        try:
-            return method(*args, **kwargs)
-        except S3ResponseError as e:
-            if e.status == 404:
-                raise cumulus.store.NotFoundError(e)
-            else:
-                raise
-    return f
+# Objects larger than the threshold are transferred in parts of the given
+# size, several parts at a time.
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=8)
+
+# Client settings: Enough pooled HTTP connections for parallel transfers
+# and multipart uploads, and retries with client-side rate limiting when
+# S3 asks us to slow down.
+CLIENT_CONFIG = Config(max_pool_connections=32,
+                       retries={"max_attempts": 10, "mode": "adaptive"},
+                       signature_version="s3v4")
+
+# Most keys S3 deletes in one DeleteObjects request.
+DELETE_BATCH = 1000
+
+# Error codes with which S3 reports a missing object.
+_NOT_FOUND_CODES = ("404", "NoSuchKey", "NotFound")
+
+def _is_not_found(error):
+    """Whether a botocore ClientError reports a missing object."""
+    return error.response.get("Error", {}).get("Code") in _NOT_FOUND_CODES
 
 class Store(cumulus.store.Store):
+    # Worker threads for get_many and put_many.  The client is thread-safe
+    # and CLIENT_CONFIG pools twice as many connections, leaving room for
+    # the parts of large uploads.
+    TRANSFER_THREADS = 16
+
+    # Objects up to this size are buffered in memory by get.
+    SMALL_OBJECT_SIZE = 1024 * 1024
+
+    # Key boundaries, after the directory prefix, at which scan splits a
+    # large listing into parts fetched in parallel.
+    SCAN_SHARDS = "123456789abcdef"
+
     def __init__(self, url):
         super(Store, self).__init__(url)
-        self.conn = boto.connect_s3(is_secure=False)
-        self.bucket = self.conn.create_bucket(url.hostname)
+        self.client = boto3.session.Session().client(
+            "s3", use_ssl=False, config=CLIENT_CONFIG)
+        self.bucket_name = url.hostname
+        self._create_bucket()
         self.prefix = url.path
         if not self.prefix.endswith("/"):
             self.prefix += "/"
         self.prefix = self.prefix.lstrip("/")
+
+        # Object sizes found by scan or stat, keyed by full key name, and the
+        # key prefixes (ending in "/") which have been scanned, mapped to the
+        # time of the scan.  Listings are recursive, so a key missing from
+        # the cache under a prefix scanned less than SCAN_TTL seconds ago
+        # does not exist.  With ?prescan=1 in the URL, the
+        # first stat in a directory scans it, replacing a request per object
+        # with one listing request per thousand objects.
         self.scan_cache = {}
+        self._scanned_prefixes = {}
+        query = cumulus.store.urlparse.parse_qs(url.query)
+        self.prescan = query.get("prescan", ["0"])[0] not in ("", "0")
+
+    def _create_bucket(self):
+        """Create the bucket unless it exists already.
+
+        Outside us-east-1 creating a bucket requires a location constraint
+        naming the region, and fails even for an existing bucket without one,
+        so only a bucket which head_bucket does not find is created.
+        """
+        try:
+            self.client.head_bucket(Bucket=self.bucket_name)
+            return
+        except ClientError as e:
+            if not _is_not_found(e):
+                raise
+        kwargs = {}
+        region = self.client.meta.region_name
+        if region and region != "us-east-1":
+            kwargs["CreateBucketConfiguration"] = {
+                "LocationConstraint": region}
+        try:
+            self.client.create_bucket(Bucket=self.bucket_name, **kwargs)
+        except ClientError as e:
+            # Someone else may have created it in the meantime.
+            if e.response.get("Error", {}).get("Code") not in (
+                    "BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                raise
 
     def _fullpath(self, path, is_directory=False):
         fullpath = self.prefix + path
@@ -57,50 +121,202 @@ class Store(cumulus.store.Store):
             fullpath += "/"
         return fullpath
 
-    def _get_key(self, path):
-        k = Key(self.bucket)
-        k.key = self._fullpath(path)
-        return k
+    def _list_pages(self, prefix, start_after=None):
+        """Iterate over pages of objects with the given prefix.
+
+        Each page is a list of dictionaries with (at least) "Key" and "Size"
+        entries.  S3 only returns keys starting with prefix, and if
+        start_after is given only those sorting after it.
+        """
+        paginator = self.client.get_paginator("list_objects_v2")
+        kwargs = {}
+        if start_after:
+            kwargs["StartAfter"] = start_after
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix,
+                                       PaginationConfig={"PageSize": 1000},
+                                       **kwargs):
+            yield page.get("Contents", ())
+
+    def _list_range(self, prefix, start_after, stop):
+        """List (key, size) of objects with the given prefix.
+
+        Only keys after start_after and up to and including stop are listed,
+        a stop of None means no upper limit.
+        """
+        result = []
+        for objects in self._list_pages(prefix, start_after):
+            for obj in objects:
+                if stop is not None and obj["Key"] > stop:
+                    return result
+                result.append((obj["Key"], obj["Size"]))
+        return result
+
+    def _list_objects(self, prefix):
+        """Iterate over lists of (key, size) for all objects with the prefix.
+
+        The lists come in key order.  If the first page of the listing does
+        not hold all objects, the rest of the key range is split at
+        SCAN_SHARDS and the pieces are listed in parallel.  Object names are
+        mostly hexadecimal, so this divides large directories about evenly.
+        """
+        response = self.client.list_objects_v2(Bucket=self.bucket_name,
+                                               Prefix=prefix, MaxKeys=1000)
+        objects = [(obj["Key"], obj["Size"])
+                   for obj in response.get("Contents", ())]
+        yield objects
+        if not (response.get("IsTruncated") and objects):
+            return
+        last = objects[-1][0]
+        bounds = [prefix + c for c in self.SCAN_SHARDS if prefix + c > last]
+        ranges = list(zip([last] + bounds, bounds + [None]))
+        pool = multiprocessing.pool.ThreadPool(len(ranges))
+        try:
+            for objects in pool.imap(lambda r: self._list_range(prefix, *r),
+                                     ranges):
+                yield objects
+        finally:
+            pool.terminate()
 
-    @throw_notfound
     def scan(self, path):
         prefix = self._fullpath(path, is_directory=True)
-        for i in self.bucket.list(prefix):
-            assert i.key.startswith(prefix)
-            self.scan_cache[i.key] = i
+        update = self.scan_cache.update
+        try:
+            for objects in self._list_objects(prefix):
+                update(objects)
+        except ClientError as e:
+            if _is_not_found(e):
+                raise cumulus.store.NotFoundError(e)
+            raise
+        self._scanned_prefixes[prefix] = time.time()
+
+    def _is_scanned(self, fullpath):
+        prefix = fullpath
+        while prefix:
+            prefix = prefix[:prefix.rfind("/", 0, len(prefix) - 1) + 1]
+            if self._scan_is_fresh(self._scanned_prefixes.get(prefix)):
+                return True
+        return False
 
-    @throw_notfound
     def list(self, path):
         prefix = self._fullpath(path, is_directory=True)
+        start = len(prefix)
         # TODO: Should use a delimiter
-        for i in self.bucket.list(prefix):
-            assert i.key.startswith(prefix)
-            yield i.key[len(prefix):]
+        try:
+            for objects in self._list_objects(prefix):
+                for key, size in objects:
+                    yield key[start:]
+        except ClientError as e:
+            if _is_not_found(e):
+                raise cumulus.store.NotFoundError(e)
+            raise
 
-    @throw_notfound
     def get(self, path):
-        fp = tempfile.TemporaryFile()
-        k = self._get_key(path)
-        k.get_file(fp)
-        fp.seek(0)
-        return fp
+        """Return a stream of the object's contents as it is downloaded.
+
+        The stream can only be read sequentially, which is all that readers
+        of segments and snapshots need, but saves spooling the whole object
+        to a temporary file before the first byte can be used.  Objects up
+        to SMALL_OBJECT_SIZE are read right away into memory instead, which
+        hands the HTTP connection back to the pool before get returns.
+        """
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name,
+                                              Key=self._fullpath(path))
+        except ClientError as e:
+            if _is_not_found(e):
+                raise cumulus.store.NotFoundError(path)
+            raise
+        body = response["Body"]
+        if response.get("ContentLength", self.SMALL_OBJECT_SIZE + 1) \
+                <= self.SMALL_OBJECT_SIZE:
+            try:
+                return io.BytesIO(body.read())
+            finally:
+                body.close()
+        return body
 
-    @throw_notfound
     def put(self, path, fp):
-        k = self._get_key(path)
-        k.set_contents_from_file(fp)
+        """Store the contents of fp.
+
+        Objects of unknown size or of at least the multipart threshold are
+        uploaded by boto3 in parts, several at a time, and an upload that
+        fails is aborted.
+        """
+        cumulus.store.advise_sequential(fp)
+        fullpath = self._fullpath(path)
+        try:
+            start = fp.tell()
+            fp.seek(0, os.SEEK_END)
+            size = fp.tell() - start
+            fp.seek(start)
+        except (AttributeError, IOError, OSError):
+            size = None
+        try:
+            if size is not None and size < TRANSFER_CONFIG.multipart_threshold:
+                # A single PUT, without the thread pool upload_fileobj
+                # starts for each call.
+                self.client.put_object(Bucket=self.bucket_name, Key=fullpath,
+                                       Body=fp.read())
+            else:
+                self.client.upload_fileobj(fp, self.bucket_name, fullpath,
+                                           Config=TRANSFER_CONFIG)
+        except ClientError as e:
+            if _is_not_found(e):
+                raise cumulus.store.NotFoundError(path)
+            raise
+        if size is not None:
+            self.scan_cache[fullpath] = size
+        else:
+            self.scan_cache.pop(fullpath, None)
+            if self._is_scanned(fullpath):
+                self.scan_cache[fullpath] = self._head_size(fullpath)
 
-    @throw_notfound
     def delete(self, path):
-        self.bucket.delete_key(self._fullpath(path))
+        fullpath = self._fullpath(path)
+        try:
+            self.client.delete_object(Bucket=self.bucket_name, Key=fullpath)
+        except ClientError as e:
+            if _is_not_found(e):
+                raise cumulus.store.NotFoundError(path)
+            raise
+        self.scan_cache.pop(fullpath, None)
+
+    def delete_many(self, paths, threads=None):
+        """Delete objects with one DeleteObjects request per DELETE_BATCH."""
+        fullpaths = [self._fullpath(path) for path in paths]
+        for i in range(0, len(fullpaths), DELETE_BATCH):
+            batch = fullpaths[i:i + DELETE_BATCH]
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={"Objects": [{"Key": key} for key in batch],
+                        "Quiet": True})
+            errors = response.get("Errors", ())
+            failed = set(error["Key"] for error in errors)
+            for key in batch:
+                if key not in failed:
+                    self.scan_cache.pop(key, None)
+            if errors:
+                raise ClientError({"Error": errors[0]}, "DeleteObjects")
+
+    def _head_size(self, fullpath):
+        response = self.client.head_object(Bucket=self.bucket_name,
+                                           Key=fullpath)
+        return response["ContentLength"]
 
     def stat(self, path):
-        path = self._fullpath(path)
-        if path in self.scan_cache:
-            k = self.scan_cache[path]
-        else:
-            k = self.bucket.get_key(path)
-        if k is None:
-            raise cumulus.store.NotFoundError
+        fullpath = self._fullpath(path)
+        if fullpath not in self.scan_cache and self.prescan \
+                and not self._is_scanned(fullpath):
+            self.scan(path.rpartition("/")[0])
+        if fullpath in self.scan_cache:
+            return {'size': self.scan_cache[fullpath]}
+        if self._is_scanned(fullpath):
+            raise cumulus.store.NotFoundError(path)
 
-        return {'size': int(k.size)}
+        try:
+            size = self.scan_cache[fullpath] = self._head_size(fullpath)
+            return {'size': size}
+        except ClientError as e:
+            if _is_not_found(e):
+                raise cumulus.store.NotFoundError(path)
+            raise
@@ -23,39 +23,59 @@ from __future__ import division, print_function, unicode_literals
 from paramiko import Transport, SFTPClient, RSAKey, DSSKey
 from paramiko.config import SSHConfig
 import paramiko.util
-from cumulus.store import Store, type_patterns, NotFoundError
+from cumulus.store import Store, NotFoundError, urlparse
+from cumulus.store import advise_sequential
+from six.moves import queue
+import atexit
+import contextlib
+import errno
+import functools
 import os, os.path
 import getpass
+import posixpath
 import re
+import stat
 import sys
+import threading
+import time
+import weakref
 
 
+# Parsed ssh config files: filename -> (modification time, SSHConfig)
+_ssh_configs = {}
+
+def _load_ssh_config(filename):
+    """parse an ssh config file, reusing the result until it changes"""
+    mtime = os.path.getmtime(filename)
+    cached = _ssh_configs.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    ssh_config = SSHConfig()
+    with open(filename) as config_file:
+        ssh_config.parse(config_file)
+    _ssh_configs[filename] = (mtime, ssh_config)
+    return ssh_config
+
 class SSHHostConfig(dict):
+    """the ssh config for a host, with the defaults filled in so that
+        lookups don't need a method of their own"""
+    __slots__ = ()
+
     def __init__(self, hostname, user = None, filename = None):
         #set defaults
         if filename == None:
             filename = os.path.expanduser('~/.ssh/config')
+        self.update(port = 22, user = getpass.getuser(), hostname = hostname)
 
         #read config file
-        ssh_config = SSHConfig()
-        with open(filename) as config_file:
-            ssh_config.parse(config_file)
+        ssh_config = _load_ssh_config(filename)
 
         self.update(ssh_config.lookup(hostname))
-
-        self.defaults={'port': 22, 'user': getpass.getuser(), 'hostname': hostname, 'hostkeyalias': hostname}
+        self.setdefault('hostkeyalias', self['hostname'])
 
         if user != None:
             self['user'] = user
 
-    def __getitem__(self, key):
-        if key in self:
-            return dict.__getitem__(self,key)
-        elif key == 'hostkeyalias' and 'hostname' in self:
-            return dict.__getitem__(self,'hostname')
-        else:
-            return self.defaults[key]
-
 
 class SFTPStore(Store):
     """implements the sftp:// storage backend
@@ -64,8 +84,21 @@ class SFTPStore(Store):
         .ssh/config files
 
         does not support password authentication or password
-        protected authentication keys"""
+        protected authentication keys
+
+        up to POOL_SIZE (or ?pool=N in the url) connections are opened
+        as needed, so that get_many and put_many transfer in parallel"""
+
+    POOL_SIZE = 4
+    # Bytes read from the local file per write in put
+    PUT_CHUNK_SIZE = 256 * 1024
+
     def __init__(self, url, **kw):
+        self.netloc = url.netloc
+        self.path = url.path
+        query = urlparse.parse_qs(url.query)
+        pool_size = int(query.get('pool', [self.POOL_SIZE])[0])
+        self.TRANSFER_THREADS = pool_size
         if self.netloc.find('@') != -1:
             user, self.netloc = self.netloc.split('@')
         else:
@@ -100,45 +133,173 @@ class SFTPStore(Store):
                 if (os.path.exists(filename)):
                     self.auth_key = DSSKey (filename)
 
-        self.__connect()
+        # File sizes from listings, stat and put, keyed by full path, and
+        # the directories (with trailing slash) which have been listed,
+        # mapped to the time of the listing.  Any file missing from the
+        # cache in a directory listed less than SCAN_TTL seconds ago is
+        # taken not to exist.
+        self.scan_cache = {}
+        self._scanned_directories = {}
+        self._init_pool(pool_size)
+        # Connect once right away so that bad urls are reported early
+        with self._acquire():
+            pass
+
+    def _init_pool(self, pool_size):
+        """set up an empty pool of at most pool_size connections"""
+        # All open (client, transport) pairs; idle clients wait in the
+        # queue, the semaphore limits how many are handed out.
+        self._connections = []
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        # An open connection keeps the process from exiting, so make sure
+        # they are closed once the store is garbage collected or at the
+        # latest when the interpreter exits.
+        if hasattr(weakref, "finalize"):
+            self._finalizer = weakref.finalize(self, _close_connections,
+                                               self._connections)
+        else:
+            self._finalizer = functools.partial(_close_connections,
+                                                self._connections)
+            atexit.register(self._finalizer)
 
     def __connect(self):
-        self.t = Transport((self.config['hostname'], self.config['port']))
-        self.t.connect(username = self.config['user'], pkey = self.auth_key)
-        self.client = SFTPClient.from_transport(self.t)
-        self.client.chdir(self.path)
+        t = Transport((self.config['hostname'], self.config['port']))
+        try:
+            t.connect(username = self.config['user'], pkey = self.auth_key)
+            client = SFTPClient.from_transport(t)
+            client.chdir(self.path)
+        except:
+            t.close()
+            raise
+        self._connections.append((client, t))
+        return client
 
-    def __build_fn(self, name):
-        return "%s/%s" % (self.path,  name)
+    @contextlib.contextmanager
+    def _acquire(self):
+        """lend out a client for the duration of a with-block, a client
+            whose connection has gone down is closed instead of returned"""
+        self._slots.acquire()
+        try:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                client = self.__connect()
+            try:
+                yield client
+            finally:
+                self.__release(client)
+        finally:
+            self._slots.release()
 
-    def list(self, type):
-        return list(filter(type_patterns[type].match, self.client.listdir(self.path)))
+    def __release(self, client):
+        if client.get_channel().get_transport().is_active():
+            self._idle.put(client)
+            return
+        for pair in self._connections:
+            if pair[0] is client:
+                self._connections.remove(pair)
+                _close_connection(*pair)
+                break
 
-    def get(self, type, name):
-        return self.client.open(self.__build_fn(name), mode = 'rb')
+    def __build_fn(self, path):
+        return "%s/%s" % (self.path,  path)
 
-    def put(self, type, name, fp):
-        remote_file = self.client.open(self.__build_fn(name), mode = 'wb')
-        buf = fp.read(4096)
-        while (len(buf) > 0):
-            remote_file.write(buf)
-            buf = fp.read(4096)
-        remote_file.close()
+    def __scanned_directory(self, directory, attrs):
+        for a in attrs:
+            if a.st_mode is None or stat.S_ISREG(a.st_mode):
+                self.scan_cache[directory + a.filename] = a.st_size
+        self._scanned_directories[directory] = time.time()
 
-    def delete(self, type, name):
-        self.client.remove(self.__build_fn(name))
+    def _is_scanned(self, fullpath):
+        directory = fullpath.rpartition("/")[0] + "/"
+        return self._scan_is_fresh(self._scanned_directories.get(directory))
 
-    def stat(self, type, name):
-        try:
-            stat = self.client.stat(self.__build_fn(name))
-            return {'size': stat.st_size}
-        except IOError:
-            raise NotFoundError
+    def scan(self, path):
+        directory = posixpath.join(self.__build_fn(path), "")
+        with self._acquire() as client:
+            try:
+                attrs = client.listdir_attr(directory)
+            except IOError as e:
+                # Scanning is only an optimization, so ignore errors; but a
+                # directory which does not exist is known to contain no files.
+                if e.errno != errno.ENOENT:
+                    return
+                attrs = []
+        self.__scanned_directory(directory, attrs)
+
+    def list(self, path):
+        """the directory is listed with file sizes, they are kept for stat"""
+        directory = posixpath.join(self.__build_fn(path), "")
+        with self._acquire() as client:
+            try:
+                attrs = client.listdir_attr(directory)
+            except IOError:
+                raise NotFoundError(path)
+        self.__scanned_directory(directory, attrs)
+        return [a.filename for a in attrs]
+
+    def get(self, path):
+        # The client can serve further requests while the file is read
+        with self._acquire() as client:
+            try:
+                remote_file = client.open(self.__build_fn(path), mode = 'rb')
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    raise NotFoundError(path)
+                raise
+        # Request the whole file right away, so that reads don't have to
+        # wait a round trip each
+        remote_file.prefetch()
+        return remote_file
+
+    def put(self, path, fp):
+        advise_sequential(fp)
+        fullpath = self.__build_fn(path)
+        with self._acquire() as client:
+            remote_file = client.open(fullpath, mode = 'wb')
+            # Don't wait for the reply to each write, errors are reported
+            # at the latest by close
+            remote_file.set_pipelined(True)
+            buf = fp.read(self.PUT_CHUNK_SIZE)
+            while (len(buf) > 0):
+                remote_file.write(buf)
+                buf = fp.read(self.PUT_CHUNK_SIZE)
+            size = remote_file.tell()
+            remote_file.close()
+        self.scan_cache[fullpath] = size
+
+    def delete(self, path):
+        fullpath = self.__build_fn(path)
+        with self._acquire() as client:
+            client.remove(fullpath)
+        self.scan_cache.pop(fullpath, None)
+
+    def stat(self, path):
+        fullpath = self.__build_fn(path)
+        if fullpath in self.scan_cache:
+            return {'size': self.scan_cache[fullpath]}
+        if self._is_scanned(fullpath):
+            raise NotFoundError(path)
+        with self._acquire() as client:
+            try:
+                attr = client.stat(fullpath)
+            except IOError:
+                raise NotFoundError(path)
+        self.scan_cache[fullpath] = attr.st_size
+        return {'size': attr.st_size}
 
     def close(self):
         """connection has to be explicitly closed, otherwise
             it will hold the process running idefinitly"""
-        self.client.close()
-        self.t.close()
+        self._finalizer()
+
+def _close_connection(client, transport):
+    client.close()
+    transport.close()
+
+def _close_connections(connections):
+    while connections:
+        _close_connection(*connections.pop())
 
 Store = SFTPStore
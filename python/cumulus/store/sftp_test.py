@@ -0,0 +1,207 @@
+#!/usr/bin/python
+#
+# Cumulus: Efficient Filesystem Backup to the Cloud
+# Copyright (C) 2014 The Cumulus Developers
+# See the AUTHORS file for a list of contributors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Unit tests for the connection pool of the cumulus.store.sftp module."""
+
+from __future__ import division, print_function, unicode_literals
+
+import errno
+import io
+import threading
+import time
+import unittest
+
+import cumulus.store
+try:
+    from cumulus.store import sftp
+except ImportError:
+    sftp = None
+
+class StubTransport(object):
+    """Stands in for paramiko.Transport, counting the connections made."""
+    opened = []
+
+    def __init__(self, addr):
+        self.active = True
+        StubTransport.opened.append(self)
+
+    def connect(self, **kw):
+        pass
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+class StubChannel(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get_transport(self):
+        return self.transport
+
+class StubReadFile(io.BytesIO):
+    def prefetch(self):
+        pass
+
+class StubWriteFile(io.BytesIO):
+    def __init__(self, files, path):
+        io.BytesIO.__init__(self)
+        self.files = files
+        self.path = path
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def close(self):
+        self.files[self.path] = self.getvalue()
+        io.BytesIO.close(self)
+
+class StubAttributes(object):
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.st_size = size
+        self.st_mode = None
+
+class StubSFTPClient(object):
+    """Stands in for paramiko.SFTPClient, keeping files in a dict."""
+    files = {}
+    lock = threading.Lock()
+    busy = 0
+    max_busy = 0
+
+    @classmethod
+    def from_transport(cls, transport):
+        client = cls()
+        client.transport = transport
+        return client
+
+    def _enter(self):
+        with self.lock:
+            StubSFTPClient.busy += 1
+            StubSFTPClient.max_busy = max(self.max_busy, self.busy)
+        # Give the other threads a chance to ask for a connection
+        time.sleep(0.02)
+        with self.lock:
+            StubSFTPClient.busy -= 1
+
+    def get_channel(self):
+        return StubChannel(self.transport)
+
+    def chdir(self, path):
+        pass
+
+    def open(self, path, mode='rb'):
+        self._enter()
+        if mode == 'wb':
+            return StubWriteFile(self.files, path)
+        if path not in self.files:
+            raise IOError(errno.ENOENT, "No such file")
+        return StubReadFile(self.files[path])
+
+    def listdir_attr(self, path):
+        return [StubAttributes(p[len(path):], len(data))
+                for p, data in self.files.items() if p.startswith(path)]
+
+    def stat(self, path):
+        if path not in self.files:
+            raise IOError(errno.ENOENT, "No such file")
+        return StubAttributes(path, len(self.files[path]))
+
+    def remove(self, path):
+        del self.files[path]
+
+    def close(self):
+        pass
+
+@unittest.skipIf(sftp is None, "paramiko is not installed")
+class SFTPPool(unittest.TestCase):
+    POOL_SIZE = 3
+
+    def setUp(self):
+        self.saved = sftp.Transport, sftp.SFTPClient
+        sftp.Transport, sftp.SFTPClient = StubTransport, StubSFTPClient
+        StubTransport.opened = []
+        StubSFTPClient.files = {}
+        StubSFTPClient.max_busy = 0
+        # Bypass the ssh configuration and key lookup of __init__
+        store = sftp.SFTPStore.__new__(sftp.SFTPStore)
+        store.path = "/backup"
+        store.config = {'hostname': 'host', 'port': 22, 'user': 'user'}
+        store.auth_key = None
+        store.scan_cache = {}
+        store._scanned_directories = {}
+        store.TRANSFER_THREADS = self.POOL_SIZE
+        store._init_pool(self.POOL_SIZE)
+        self.store = store
+
+    def tearDown(self):
+        self.store.close()
+        sftp.Transport, sftp.SFTPClient = self.saved
+
+    def test_get_many(self):
+        paths = ["segments/%d" % i for i in range(10)]
+        for i, path in enumerate(paths):
+            StubSFTPClient.files["/backup/" + path] = b"x" * i
+        files = self.store.get_many(paths)
+        self.assertEqual([len(f.read()) for f in files], list(range(10)))
+        self.assertTrue(1 < len(StubTransport.opened) <= self.POOL_SIZE)
+        self.assertTrue(1 < StubSFTPClient.max_busy <= self.POOL_SIZE)
+
+    def test_get_many_missing(self):
+        StubSFTPClient.files["/backup/a"] = b"a"
+        self.assertRaises(cumulus.store.NotFoundError,
+                          self.store.get_many, ["a", "b"])
+
+    def test_put_many_and_stat(self):
+        self.store.put_many([("segments/%d" % i, io.BytesIO(b"y" * i))
+                             for i in range(6)])
+        self.assertEqual(StubSFTPClient.files["/backup/segments/5"], b"yyyyy")
+        self.assertEqual(self.store.stat_many(["segments/2", "segments/4"]),
+                         [{'size': 2}, {'size': 4}])
+        self.assertEqual(sorted(self.store.list("segments")),
+                         [str(i) for i in range(6)])
+        self.store.delete_many(["segments/0", "segments/1"])
+        self.assertRaises(cumulus.store.NotFoundError,
+                          self.store.stat, "segments/0")
+
+    def test_scan_expires(self):
+        self.store.scan("segments")
+        StubSFTPClient.files["/backup/segments/new"] = b"new"
+        self.assertRaises(cumulus.store.NotFoundError,
+                          self.store.stat, "segments/new")
+        self.store.SCAN_TTL = 0
+        self.assertEqual(self.store.stat("segments/new"), {'size': 3})
+
+    def test_broken_connection_is_discarded(self):
+        StubSFTPClient.files["/backup/a"] = b"a"
+        self.store.stat("a")
+        StubTransport.opened[0].active = False
+        self.store.scan_cache.clear()
+        self.store.stat("a")
+        self.assertEqual(self.store._connections, [])
+        self.store.scan_cache.clear()
+        self.store.stat("a")
+        self.assertEqual(len(StubTransport.opened), 2)
+        self.assertEqual(len(self.store._connections), 1)
+
+if __name__ == "__main__":
+    unittest.main()
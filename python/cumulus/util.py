@@ -22,6 +22,7 @@ from __future__ import division, print_function, unicode_literals
 
 import re
 import six
+from six.moves.urllib.parse import unquote_to_bytes
 
 # The encoding assumed when interpreting path names.
 ENCODING="utf-8"
@@ -59,19 +60,22 @@ def uri_decode_raw(s):
 
     The input should be a string, preferably only using ASCII characters.  The
     output will be of type bytes."""
-    def hex_decode(m): return six.int2byte(int(m.group(1), 16))
-    return re.sub(br"%([0-9a-fA-F]{2})", hex_decode, pathname_to_bytes(s))
+    return unquote_to_bytes(pathname_to_bytes(s))
+
+# Encoded form of each byte value.  Allow certain literal characters:
+# c > "+" and c < "\x7f" and c != "@"
+_URI_ENCODE = [six.unichr(c) if c > 0x2b and c < 0x7f and c != 0x40
+               else "%%%02x" % c for c in range(256)]
+_URI_ESCAPED = re.compile(br"[^,-~]|@")
+# The same test for Python 3 pathnames (on Python 2 they might be either bytes
+# or unicode, so they are always encoded first).
+_URI_ESCAPED_PATHNAME = re.compile(r"[^,-~]|@")
 
 def uri_encode_raw(s):
     """Encode a bytes array to URI-encoded (%xx escapes) form."""
-    def hex_encode(c):
-        # Allow certain literal characters: c > "+" and c < "\x7f" and c != "@"
-        if c > 0x2b and c < 0x7f and c != 0x40:
-            return chr(c)
-        else:
-            return "%%%02x" % c
-
-    return "".join(hex_encode(c) for c in six.iterbytes(s))
+    if not _URI_ESCAPED.search(s):
+        return s.decode("ascii")
+    return "".join(map(_URI_ENCODE.__getitem__, bytearray(s)))
 
 def uri_decode_pathname(s):
     """Decodes a URI-encoded string to a pathname."""
@@ -79,4 +83,7 @@ def uri_decode_pathname(s):
 
 def uri_encode_pathname(p):
     """Encodes a pathname to a URI-encoded string."""
+    if six.PY3 and not _URI_ESCAPED_PATHNAME.search(p):
+        # Only ASCII characters which encode to themselves
+        return p
     return uri_encode_raw(pathname_to_bytes(p))
@@ -52,6 +52,10 @@ class UtilCodecs(unittest.TestCase):
         self.assertEqual(util.uri_encode_raw(b"sample ASCII"), "sample%20ASCII")
         self.assertEqual(util.uri_encode_raw(b"sample ext\xc3\xa9nded"),
                          "sample%20ext%c3%a9nded")
+        self.assertEqual(util.uri_encode_raw(b"dir/file-1.txt"),
+                         "dir/file-1.txt")
+        self.assertEqual(util.uri_encode_raw(b"user@host+x"),
+                         "user%40host%2bx")
 
     def test_uri_decode_raw(self):
         self.assertEqual(util.uri_decode_raw("sample%20ASCII"), b"sample ASCII")